@@ -0,0 +1,120 @@
+"""
+Drives the RAG load balancer against local stub servers with different
+latencies, one of which starts failing halfway through, and compares the
+selection strategies with plain round-robin.
+
+Run from the repository root:
+    python -m benchmarks.rag_balancer
+"""
+
+import asyncio
+import itertools
+import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+import aiohttp
+from aiohttp import web
+
+os.environ.setdefault("GRAPH_RAG_SERVICE_HOST", "127.0.0.1")
+os.environ.setdefault("GRAPH_RAG_SERVICE_PORT", "0")
+os.environ.setdefault("VECTOR_RAG_SERVICE_HOST", "127.0.0.1")
+os.environ.setdefault("VECTOR_RAG_SERVICE_PORT", "0")
+
+from fastapi import HTTPException
+from src.services.rag.requests.qa import get_answer_request
+from src.services.rag.schemas.qa import AnswerGenerationCredentials
+from src.services.rag.utils.balancer import RagBalancer
+
+STUBS = {9101: 0.05, 9102: 0.1, 9103: 0.4, 9104: 0.05}
+FAILING_PORT = 9104
+
+
+def make_stub(latency: float, state: dict) -> web.Application:
+    async def answer(request: web.Request) -> web.Response:
+        await asyncio.sleep(latency)
+        if state["failing"]:
+            return web.json_response({"detail": "stub failure"}, status=500)
+        return web.json_response({"content": "stub answer", "traceback": []})
+
+    app = web.Application()
+    app.router.add_post("/answer", answer)
+    return app
+
+
+class RoundRobin:
+    def __init__(self, urls: list[str]):
+        self.urls = itertools.cycle(urls)
+
+    @asynccontextmanager
+    async def instance(self):
+        yield type("Instance", (), {"url": next(self.urls)})
+
+
+async def drive(balancer, requests: int, concurrency: int, state: dict) -> None:
+    credentials = AnswerGenerationCredentials(vault_id=None, query="q", history=[])
+    semaphore = asyncio.Semaphore(concurrency)
+    picked = Counter()
+    errors = 0
+    done = 0
+
+    async def one(session: aiohttp.ClientSession) -> None:
+        nonlocal errors, done
+        async with semaphore:
+            try:
+                async with balancer.instance() as instance:
+                    picked[urlsplit(instance.url).port] += 1
+                    await get_answer_request(
+                        session=session,
+                        pydantic_model=credentials,
+                        endpoint=instance.url,
+                    )
+            except HTTPException:
+                errors += 1
+        done += 1
+        if done == requests // 2:
+            state["failing"] = True
+
+    started_at = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(one(session) for _ in range(requests)))
+    elapsed = time.perf_counter() - started_at
+    print(
+        f"  {elapsed:6.2f}s  errors {errors:4d}  "
+        + "  ".join(f"{port}: {picked[port]:4d}" for port in STUBS)
+    )
+
+
+async def main(requests: int = 2000, concurrency: int = 32) -> None:
+    urls = [f"http://127.0.0.1:{port}/answer" for port in STUBS]
+    for name in ("round_robin", "least_outstanding", "power_of_two"):
+        state = {"failing": False}
+        runners = []
+        for port, latency in STUBS.items():
+            stub_state = state if port == FAILING_PORT else {"failing": False}
+            runner = web.AppRunner(make_stub(latency, stub_state))
+            await runner.setup()
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+            runners.append(runner)
+
+        if name == "round_robin":
+            balancer = RoundRobin(urls)
+        else:
+            balancer = RagBalancer(
+                backend="graph",
+                urls=urls,
+                strategy=name,
+                failure_threshold=3,
+                ejection_time=5,
+                latency_decay=0.2,
+            )
+        print(name)
+        await drive(balancer, requests=requests, concurrency=concurrency, state=state)
+
+        for runner in runners:
+            await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
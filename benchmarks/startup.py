@@ -0,0 +1,91 @@
+"""
+Measures cold start of the tokenizer backends in fresh interpreters.
+
+transformers is no longer a requirement, so the baseline runs in a virtualenv
+of its own, created in benchmarks/.venv on the first run.
+
+Run from the repository root:
+    python -m benchmarks.startup
+"""
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+from src.config import settings
+
+BASELINE_REQUIREMENTS = ["transformers==4.40.2"]
+BASELINE_VENV = Path(__file__).parent / ".venv"
+
+TRANSFORMERS_BACKEND = f"""
+from transformers import AutoTokenizer
+AutoTokenizer.from_pretrained({settings.tokenizer.name!r})
+"""
+
+TOKENIZERS_BACKEND = f"""
+from tokenizers import Tokenizer
+Tokenizer.from_file({str(settings.tokenizer.path)!r})
+"""
+
+GATEWAY_IMPORT = """
+import src.main
+"""
+
+PROBE = """
+import json, resource, time
+start = time.perf_counter()
+exec({code!r})
+elapsed = time.perf_counter() - start
+rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+print(json.dumps({{"seconds": elapsed, "max_rss_mb": rss_mb}}))
+"""
+
+
+def baseline_python() -> str:
+    python = BASELINE_VENV / "bin" / "python"
+    if not python.exists():
+        print(f"Installing {' '.join(BASELINE_REQUIREMENTS)} into {BASELINE_VENV}")
+        subprocess.run(
+            [sys.executable, "-m", "venv", "--system-site-packages", BASELINE_VENV],
+            check=True,
+        )
+        subprocess.run(
+            [python, "-m", "pip", "install", "-q", *BASELINE_REQUIREMENTS], check=True
+        )
+    return str(python)
+
+
+def measure(python: str, code: str, runs: int) -> dict | None:
+    samples = []
+    for _ in range(runs):
+        completed = subprocess.run(
+            [python, "-c", PROBE.format(code=code)],
+            capture_output=True,
+            text=True,
+        )
+        if completed.returncode != 0:
+            print(completed.stderr.strip().splitlines()[-1], file=sys.stderr)
+            return None
+        samples.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+    return {
+        "seconds": min(sample["seconds"] for sample in samples),
+        "max_rss_mb": min(sample["max_rss_mb"] for sample in samples),
+    }
+
+
+def main(runs: int = 3) -> None:
+    cases = {
+        "transformers.AutoTokenizer": (baseline_python(), TRANSFORMERS_BACKEND),
+        "tokenizers.Tokenizer": (sys.executable, TOKENIZERS_BACKEND),
+        "src.main import (lazy tokenizer)": (sys.executable, GATEWAY_IMPORT),
+    }
+    for name, (python, code) in cases.items():
+        result = measure(python, code, runs=runs)
+        if result is None:
+            print(f"{name:<36} skipped")
+            continue
+        print(f"{name:<36} {result['seconds']:8.3f} s {result['max_rss_mb']:10.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
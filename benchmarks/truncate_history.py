@@ -0,0 +1,53 @@
+"""
+Compares the backwards linear scan with the prefix-sum binary search used by
+truncate_history on synthetic histories, and checks both give the same cut.
+
+Run from the repository root:
+    python -m benchmarks.truncate_history
+"""
+
+import random
+import timeit
+from itertools import accumulate
+from src.services.rag.utils.history import truncate_by_prefix_sums
+
+
+def truncate_linear(history: list, counts: list[int], max_tokens: int) -> list:
+    tokens = 0
+    for i in range(len(history) - 1, -1, -1):
+        tokens += counts[i]
+        if tokens >= max_tokens:
+            return history[i + 1 :]
+    return history
+
+
+def main(sizes: tuple[int, ...] = (1_000, 10_000, 50_000, 100_000)) -> None:
+    random.seed(0)
+    for size in sizes:
+        history = list(range(size))
+        counts = [random.randint(1, 400) for _ in range(size)]
+        prefix_sums = list(accumulate(counts, initial=0))
+        budgets = [0, 1, 3000, 7000, prefix_sums[-1] // 2, prefix_sums[-1] + 1]
+
+        for max_tokens in budgets:
+            assert truncate_linear(history, counts, max_tokens) == (
+                truncate_by_prefix_sums(history, prefix_sums, max_tokens)
+            )
+
+        max_tokens = prefix_sums[-1] // 2
+        number = 20
+        linear = timeit.timeit(
+            lambda: truncate_linear(history, counts, max_tokens), number=number
+        )
+        bisected = timeit.timeit(
+            lambda: truncate_by_prefix_sums(history, prefix_sums, max_tokens),
+            number=number,
+        )
+        print(
+            f"{size:>7} messages: linear {linear / number * 1e3:9.3f} ms, "
+            f"prefix sums {bisected / number * 1e3:9.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
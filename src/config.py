@@ -1,5 +1,12 @@
 from pathlib import Path
-from pydantic import BaseModel, FilePath
+from typing import Any
+from pydantic import (
+    BaseModel,
+    FilePath,
+    ValidationInfo,
+    field_validator,
+    model_validator,
+)
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 BASE_DIR = Path(__file__).parent.parent
@@ -9,16 +16,79 @@ class JWTAuth(BaseModel):
     private_key_path: FilePath = BASE_DIR / "certs" / "jwt-private.pem"
     public_key_path: FilePath = BASE_DIR / "certs" / "jwt-public.pem"
     algorithm: str = "RS256"
+    # Tokens with a "kid" header are verified with the matching key of this JWKS
+    key_set_path: Path = BASE_DIR / "certs" / "jwks.json"
+    key_set_reload_interval: float = 5
+    algorithms: list[str] = ["RS256", "ES256", "EdDSA"]
     access_token_expire_minutes: int = 15
     refresh_token_expire_hours: int = 24
+    claims_cache_size: int = 10000
+
+
+class TokenizerModel(BaseModel):
+    name: str = "lightblue/suzume-llama-3-8B-multilingual"
+    path: Path = (
+        BASE_DIR / "models" / "suzume-llama-3-8B-multilingual" / "tokenizer.json"
+    )
+
+
+class CacheTTL(BaseModel):
+    soft: int
+    hard: int
+
+    @model_validator(mode="after")
+    def check_order(self) -> "CacheTTL":
+        if not 0 < self.soft < self.hard:
+            raise ValueError("Cache TTLs need 0 < soft < hard")
+        return self
+
+    def is_stale(self, ttl_left: int) -> bool:
+        # Redis reports what is left of the hard TTL, keys without one never go stale
+        return 0 <= ttl_left < self.hard - self.soft
+
+
+class RateLimit(BaseModel):
+    capacity: int
+    refill_rate: float
 
 
 class Setting(BaseSettings):
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
     jwt_auth: JWTAuth = JWTAuth()
+    tokenizer: TokenizerModel = TokenizerModel()
     redis_host: str
     redis_port: int
     client_cache_ttl: int = 600
+    # Past "soft" a cached entry is served while it is refreshed in the background
+    cache_ttls: dict[str, CacheTTL] = {
+        namespace: CacheTTL(soft=600, hard=3600)
+        for namespace in ("chat", "chats", "vault", "documents", "vaults_preview")
+    }
+    idempotency_ttl: int = 60 * 60 * 24
+    idempotency_lease: int = 30
+    idempotency_wait: float = 300
+    idempotency_poll_interval: float = 0.5
+    local_cache_enabled: bool = True
+    local_cache_max_bytes: int = 32 * 1024 * 1024
+    local_cache_ttl: float = 5
+    vault_types_max_size: int = 100_000
+    single_flight_lease: int = 5
+    single_flight_poll_interval: float = 0.05
+    rate_limit_enabled: bool = True
+    # Bucket size and tokens refilled per second for every route class
+    rate_limits: dict[str, RateLimit] = {
+        "generation": RateLimit(capacity=10, refill_rate=0.2),
+        "uploads": RateLimit(capacity=5, refill_rate=0.05),
+        "reads": RateLimit(capacity=60, refill_rate=2),
+    }
+
+    @field_validator("cache_ttls", "rate_limits", mode="before")
+    @classmethod
+    def merge_defaults(cls, value: Any, info: ValidationInfo) -> Any:
+        # Namespaces missing from the environment keep their defaults
+        if not isinstance(value, dict):
+            return value
+        return {**cls.model_fields[info.field_name].default, **value}
 
 
 settings: Setting = Setting()
@@ -1,9 +1,10 @@
-from fastapi import Request, Depends
+from fastapi import Request, Response, WebSocket, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import aiohttp
 from typing_extensions import Annotated
 from src.utils import decode_jwt
 from src.schemas import JWTPayload
+from src.rate_limit import rate_limiter
 
 http_bearer = HTTPBearer()
 
@@ -12,6 +13,12 @@ async def get_aiohttp_session(request: Request) -> aiohttp.ClientSession:
     return request.state.client_session
 
 
+async def get_websocket_aiohttp_session(
+    websocket: WebSocket,
+) -> aiohttp.ClientSession:
+    return websocket.state.client_session
+
+
 async def parse_jwt_bearer(
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(http_bearer)],
 ) -> JWTPayload:
@@ -25,3 +32,24 @@ async def parse_jwt_token(token: str | None = None) -> JWTPayload:
     dict_payload = await decode_jwt(token=token)
     payload = JWTPayload.model_validate(dict_payload)
     return payload
+
+
+def rate_limit(route_class: str):
+    async def check_rate_limit(
+        response: Response,
+        jwt_payload: Annotated[JWTPayload, Depends(parse_jwt_bearer)],
+    ) -> dict[str, str]:
+        decision = await rate_limiter.check(
+            route_class=route_class, user_id=jwt_payload.user_id
+        )
+        headers = dict() if decision is None else decision.headers
+        # Endpoints returning a Response of their own have to pass these on
+        response.headers.update(headers)
+        return headers
+
+    return check_rate_limit
+
+
+limit_generation = rate_limit("generation")
+limit_uploads = rate_limit("uploads")
+limit_reads = rate_limit("reads")
@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable, TypeVar
+from fastapi import HTTPException, status
+from pydantic import BaseModel
+from src.config import settings
+from src.metrics import metrics
+from src.repositories.redis import RedisRepository
+
+Model = TypeVar("Model", bound=BaseModel)
+
+
+class IdempotencyStore:
+    # The record is {"status": "in_flight" | "done", "fingerprint", "owner"} and
+    # the serialized response once done. Failed executions drop the record, so
+    # only successful responses are replayed. The in-flight lease is renewed for
+    # as long as the call runs, and only lapses when its worker dies
+    release_script = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+    renew_script = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('EXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    def __init__(
+        self,
+        redis_repository: type(RedisRepository),
+        ttl: int,
+        lease: int,
+        wait: float,
+        poll_interval: float,
+    ):
+        self.redis: RedisRepository = redis_repository()
+        self.cache_prefix = "idempotency:"
+        self.ttl = ttl
+        self.lease = lease
+        self.wait = wait
+        self.poll_interval = poll_interval
+
+    @staticmethod
+    def make_digest(content: str) -> str:
+        return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+    def make_key(self, scope: str, user_id: uuid.UUID, idempotency_key: str) -> str:
+        return (
+            f"{self.cache_prefix}{scope}:{user_id.hex}:"
+            f"{self.make_digest(idempotency_key)}"
+        )
+
+    async def claim(self, key: str, fingerprint: str) -> tuple[str | None, dict | None]:
+        # Returns the in-flight record when claimed, otherwise the finished record
+        started_at = time.monotonic()
+        in_flight = json.dumps(
+            {
+                "status": "in_flight",
+                "fingerprint": fingerprint,
+                "owner": uuid.uuid4().hex,
+            }
+        )
+        while True:
+            if await self.redis.set_if_absent(key, in_flight, ttl=self.lease):
+                return in_flight, None
+
+            # Gone between the two calls when None, the claim is simply retried
+            record = await self.redis.get(key)
+            if record is not None:
+                record = json.loads(record)
+                if record["fingerprint"] != fingerprint:
+                    raise HTTPException(
+                        status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                        detail="Idempotency-Key was already used with a different request",
+                    )
+                if record["status"] == "done":
+                    return None, record
+
+            if time.monotonic() - started_at >= self.wait:
+                metrics.increment("idempotency.wait_timeouts")
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail="Request with this Idempotency-Key is still in progress",
+                    headers={"Retry-After": str(max(1, round(self.poll_interval)))},
+                )
+            await asyncio.sleep(self.poll_interval)
+
+    async def renew(self, key: str, in_flight: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                if not await self.redis.eval_script(
+                    self.renew_script, keys=[key], args=[in_flight, self.lease]
+                ):
+                    return
+            except Exception as generic_error:
+                logging.error(f"Idempotency store error: {generic_error}")
+
+    async def release(self, key: str, in_flight: str) -> None:
+        try:
+            await self.redis.eval_script(
+                self.release_script, keys=[key], args=[in_flight]
+            )
+        except Exception as generic_error:
+            logging.error(f"Idempotency store error: {generic_error}")
+
+    async def execute(
+        self,
+        scope: str,
+        user_id: uuid.UUID,
+        idempotency_key: str,
+        fingerprint: str,
+        model: type[Model],
+        call: Callable[[], Awaitable[Model]],
+    ) -> tuple[Model, bool]:
+        key = self.make_key(scope, user_id, idempotency_key)
+        fingerprint = self.make_digest(fingerprint)
+        started_at = time.perf_counter()
+        try:
+            in_flight, record = await self.claim(key, fingerprint)
+        except HTTPException:
+            raise
+        except Exception as generic_error:
+            # A Redis outage should not take the endpoint down with it
+            logging.error(f"Idempotency store error: {generic_error}")
+            return await call(), False
+
+        if record is not None:
+            metrics.increment(f"idempotency.{scope}.replayed")
+            metrics.observe(
+                f"idempotency.{scope}.replay_wait", time.perf_counter() - started_at
+            )
+            return model.model_validate_json(record["response"]), True
+
+        metrics.increment(f"idempotency.{scope}.executed")
+        renewal = asyncio.create_task(self.renew(key, in_flight))
+        try:
+            result = await call()
+        except BaseException:
+            await asyncio.shield(self.release(key, in_flight))
+            raise
+        finally:
+            renewal.cancel()
+
+        try:
+            await self.redis.set(
+                key,
+                json.dumps(
+                    {
+                        "status": "done",
+                        "fingerprint": fingerprint,
+                        "response": result.model_dump_json(),
+                    }
+                ),
+                ttl=self.ttl,
+            )
+        except Exception as generic_error:
+            logging.error(f"Idempotency store error: {generic_error}")
+        return result, False
+
+
+idempotency_store = IdempotencyStore(
+    RedisRepository,
+    ttl=settings.idempotency_ttl,
+    lease=settings.idempotency_lease,
+    wait=settings.idempotency_wait,
+    poll_interval=settings.idempotency_poll_interval,
+)
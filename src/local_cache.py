@@ -0,0 +1,160 @@
+import asyncio
+import json
+import logging
+import time
+from collections import Counter, OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+from src.config import settings
+from src.metrics import metrics
+from src.repositories.redis import RedisRepository
+
+
+@dataclass
+class LocalEntry:
+    value: Any
+    size: int
+    expires_at: float
+
+
+class LocalCache:
+    # Parsed values of Redis keys kept per worker in front of the cache managers.
+    # Deletes are broadcast so every worker drops its copy, overwrites are only
+    # dropped locally and become visible elsewhere once the short TTL runs out
+    def __init__(
+        self,
+        redis_repository: type(RedisRepository),
+        enabled: bool,
+        max_bytes: int,
+        ttl: float,
+        channel: str,
+    ):
+        self.redis: RedisRepository = redis_repository()
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.channel = channel
+        self.entries: OrderedDict[str, LocalEntry] = OrderedDict()
+        self.size = 0
+        # Bumped on every invalidation, so a load that raced one is not stored
+        self.version = 0
+        self.counts: Counter[str] = Counter()
+        self.listener: asyncio.Task | None = None
+        # Called with the dropped keys, or None when everything is dropped
+        self.drop_hooks: list[Callable[[tuple[str, ...] | None], None]] = []
+
+    def count(self, name: str) -> None:
+        self.counts[name] += 1
+        metrics.increment(f"cache.{name}")
+        for tier in ("l1", "l2"):
+            total = self.counts[f"{tier}_hits"] + self.counts[f"{tier}_misses"]
+            if total:
+                metrics.set_gauge(
+                    f"cache.{tier}_hit_ratio", self.counts[f"{tier}_hits"] / total
+                )
+
+    async def get(
+        self,
+        key: str,
+        load: Callable[[], Awaitable[str | None]],
+        parse: Callable[[str], Any],
+    ) -> Any:
+        entry = self.entries.get(key) if self.enabled else None
+        if entry is not None:
+            if entry.expires_at > time.monotonic():
+                self.entries.move_to_end(key)
+                self.count("l1_hits")
+                return entry.value
+            self.remove(key)
+        if self.enabled:
+            self.count("l1_misses")
+
+        version = self.version
+        result = await load()
+        if result is None:
+            self.count("l2_misses")
+            return None
+        self.count("l2_hits")
+
+        value = parse(result)
+        if value is not None and self.enabled and version == self.version:
+            self.put(key, value, size=len(result.encode()))
+        return value
+
+    def put(self, key: str, value: Any, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        self.remove(key)
+        while self.entries and self.size + size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            metrics.increment("cache.l1_evictions")
+        self.entries[key] = LocalEntry(
+            value=value, size=size, expires_at=time.monotonic() + self.ttl
+        )
+        self.size += size
+        metrics.set_gauge("cache.l1_bytes", self.size)
+
+    def on_drop(self, hook: Callable[[tuple[str, ...] | None], None]) -> None:
+        # Lets caches kept outside the entries follow the invalidations
+        self.drop_hooks.append(hook)
+
+    def drop(self, *keys: str) -> None:
+        # For overwrites, a load that read the old value is not stored either
+        self.remove(*keys)
+        self.version += 1
+        for hook in self.drop_hooks:
+            hook(keys)
+
+    def remove(self, *keys: str) -> None:
+        for key in keys:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.size -= entry.size
+        metrics.set_gauge("cache.l1_bytes", self.size)
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.size = 0
+        self.version += 1
+        metrics.set_gauge("cache.l1_bytes", self.size)
+        for hook in self.drop_hooks:
+            hook(None)
+
+    async def invalidate(self, *keys: str) -> None:
+        self.drop(*keys)
+        if not self.enabled:
+            return
+        try:
+            await self.redis.publish(self.channel, json.dumps(keys))
+        except Exception as generic_error:
+            logging.error(f"Cache invalidation publish error: {generic_error}")
+
+    async def listen(self) -> None:
+        while True:
+            try:
+                async for message in self.redis.subscribe(self.channel):
+                    self.drop(*json.loads(message))
+            except Exception as generic_error:
+                logging.error(f"Cache invalidation channel error: {generic_error}")
+            # Invalidations sent while the subscription was down are lost
+            self.clear()
+            await asyncio.sleep(1)
+
+    def start(self) -> None:
+        if self.enabled:
+            self.listener = asyncio.create_task(self.listen())
+
+    async def stop(self) -> None:
+        if self.listener is not None:
+            self.listener.cancel()
+            await asyncio.gather(self.listener, return_exceptions=True)
+
+
+local_cache = LocalCache(
+    RedisRepository,
+    enabled=settings.local_cache_enabled,
+    max_bytes=settings.local_cache_max_bytes,
+    ttl=settings.local_cache_ttl,
+    channel="cache:invalidations",
+)
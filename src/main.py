@@ -1,10 +1,18 @@
+# Imported first, so startup.seconds covers the imports as well as the lifespan
+from src.metrics import metrics
+import time
 from fastapi import FastAPI
 import aiohttp
+import asyncio
 from contextlib import asynccontextmanager
 from src.services.authorization.api import auth_router
 from src.services.vaults.api import vault_router
 from src.services.messaging.api import messaging_router
 from src.services.rag.api import qa_router
+from src.services.rag.utils.tokenizer import tokenizer_service
+from src.services.messaging.utils.history_writer import history_writer
+from src.local_cache import local_cache
+from src.services.rag.service import batch_runner
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 
@@ -12,8 +20,17 @@ import uvicorn
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     timeout = aiohttp.ClientTimeout(total=120, connect=5)
+    tokenizer_warmup = asyncio.create_task(tokenizer_service.warmup())
     async with aiohttp.ClientSession(timeout=timeout) as session:
+        history_writer.start(session=session)
+        local_cache.start()
+        metrics.set_gauge("startup.seconds", time.perf_counter() - metrics.created_at)
         yield {"client_session": session}
+        await batch_runner.shutdown()
+        await history_writer.drain()
+        await local_cache.stop()
+    tokenizer_warmup.cancel()
+    tokenizer_service.shutdown()
 
 
 app = FastAPI(lifespan=lifespan, title="Papper API", version="0.0.7", root_path="/api")
@@ -42,6 +59,11 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics")
+async def get_metrics():
+    return metrics.snapshot()
+
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
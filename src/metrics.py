@@ -0,0 +1,36 @@
+import time
+from collections import defaultdict
+
+
+class Metrics:
+    def __init__(self):
+        self.counters: dict[str, float] = defaultdict(float)
+        self.gauges: dict[str, float] = dict()
+        self.timings: dict[str, dict[str, float]] = dict()
+        self.created_at = time.perf_counter()
+
+    def increment(self, name: str, value: float = 1) -> None:
+        self.counters[name] += value
+
+    def set_gauge(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float) -> None:
+        timing = self.timings.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        timing["count"] += 1
+        timing["total"] += seconds
+        timing["max"] = max(timing["max"], seconds)
+
+    def snapshot(self) -> dict:
+        timings = {
+            name: {**timing, "avg": timing["total"] / timing["count"]}
+            for name, timing in self.timings.items()
+        }
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "timings": timings,
+        }
+
+
+metrics = Metrics()
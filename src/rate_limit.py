@@ -0,0 +1,107 @@
+import logging
+import math
+import uuid
+from dataclasses import dataclass
+from fastapi import HTTPException, status
+from src.config import settings, RateLimit
+from src.metrics import metrics
+from src.repositories.redis import RedisRepository
+
+
+@dataclass
+class RateLimitDecision:
+    allowed: bool
+    limit: int
+    remaining: int
+    retry_after: float
+
+    @property
+    def headers(self) -> dict[str, str]:
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(self.remaining),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(math.ceil(self.retry_after))
+        return headers
+
+
+class RateLimiter:
+    # The bucket is a hash of the tokens left and the time of the last refill,
+    # refilled and charged in one script so concurrent workers cannot overdraw it.
+    # A cost above the capacity needs a full bucket and leaves it in debt
+    bucket_script = """
+    local capacity = tonumber(ARGV[1])
+    local refill_rate = tonumber(ARGV[2])
+    local cost = tonumber(ARGV[3])
+    local time = redis.call('TIME')
+    local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated_at = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * refill_rate)
+    local required = math.min(cost, capacity)
+    local allowed = 0
+    local retry_after = 0
+    if tokens >= required then
+        tokens = tokens - cost
+        allowed = 1
+    else
+        retry_after = (required - tokens) / refill_rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil((capacity - tokens) / refill_rate) + 1)
+    return {allowed, tostring(tokens), tostring(retry_after)}
+    """
+
+    def __init__(
+        self,
+        redis_repository: type(RedisRepository),
+        enabled: bool,
+        limits: dict[str, RateLimit],
+    ):
+        self.redis: RedisRepository = redis_repository()
+        self.cache_prefix = "rate_limit:"
+        self.enabled = enabled
+        self.limits = limits
+
+    async def check(
+        self, route_class: str, user_id: uuid.UUID, cost: int = 1
+    ) -> RateLimitDecision | None:
+        limit = self.limits.get(route_class)
+        if not self.enabled or limit is None:
+            return None
+
+        try:
+            allowed, tokens, retry_after = await self.redis.eval_script(
+                self.bucket_script,
+                keys=[f"{self.cache_prefix}{route_class}:{user_id.hex}"],
+                args=[limit.capacity, limit.refill_rate, cost],
+            )
+        except Exception as generic_error:
+            # A Redis outage should not lock every user out
+            logging.error(f"Rate limiter error: {generic_error}")
+            return None
+
+        decision = RateLimitDecision(
+            allowed=bool(allowed),
+            limit=limit.capacity,
+            remaining=max(0, math.floor(float(tokens))),
+            retry_after=float(retry_after),
+        )
+        if not decision.allowed:
+            metrics.increment(f"rate_limit.{route_class}.rejected")
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Rate limit exceeded",
+                headers=decision.headers,
+            )
+        metrics.increment(f"rate_limit.{route_class}.allowed")
+        return decision
+
+
+rate_limiter = RateLimiter(
+    RedisRepository,
+    enabled=settings.rate_limit_enabled,
+    limits=settings.rate_limits,
+)
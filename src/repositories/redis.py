@@ -1,6 +1,8 @@
+import asyncio
 from contextlib import asynccontextmanager
-from typing import AsyncIterator
+from typing import Any, AsyncIterator
 import redis.asyncio as aioredis
+from redis.asyncio.lock import Lock
 from .abstract import KeyValueDBAbstractRepository
 from src.config import settings
 import logging
@@ -11,6 +13,47 @@ class RedisRepository(KeyValueDBAbstractRepository):
         host=settings.redis_host, port=settings.redis_port, decode_responses=True
     )
     client_cache_ttl = settings.client_cache_ttl
+    scripts: dict[str, Any] = dict()
+
+    # A tag is a sorted set of the keys written under it scored by their expiry,
+    # so a group of keys is found without scanning the keyspace
+    set_tagged_script = """
+    if KEYS[3] and (redis.call('GET', KEYS[3]) or '0') ~= ARGV[3] then
+        return 0
+    end
+    local now = tonumber(redis.call('TIME')[1])
+    local ttl = tonumber(ARGV[2])
+    redis.call('SET', KEYS[1], ARGV[1], 'EX', ttl)
+    redis.call('ZADD', KEYS[2], now + ttl, KEYS[1])
+    -- Members that expired are pruned on every write
+    redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+    -- Outlives every member, as they are all written with the same TTL
+    redis.call('EXPIRE', KEYS[2], ttl)
+    return 1
+    """
+    delete_by_tag_script = """
+    local keys = redis.call('ZRANGE', KEYS[1], 0, -1)
+    for i = 1, #keys, 1000 do
+        redis.call('DEL', unpack(keys, i, math.min(i + 999, #keys)))
+    end
+    redis.call('DEL', KEYS[1])
+    return #keys
+    """
+    get_by_tag_script = """
+    local now = tonumber(redis.call('TIME')[1])
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+    local keys = redis.call('ZRANGE', KEYS[1], 0, -1)
+    local values = {}
+    for i = 1, #keys, 1000 do
+        local chunk = redis.call('MGET', unpack(keys, i, math.min(i + 999, #keys)))
+        for j = 1, #chunk do
+            if chunk[j] then
+                table.insert(values, chunk[j])
+            end
+        end
+    end
+    return values
+    """
 
     @asynccontextmanager
     async def redis_transaction(self) -> AsyncIterator[aioredis.client.Pipeline]:
@@ -28,25 +71,169 @@ class RedisRepository(KeyValueDBAbstractRepository):
         ttl = self.client_cache_ttl if ttl is None else ttl
         return await self.client.set(key, value, ex=ttl)
 
-    async def delete(self, key) -> bool:
-        return await self.client.delete(key)
+    async def set_if_absent(self, key, value, ttl: int | None = None) -> bool:
+        ttl = self.client_cache_ttl if ttl is None else ttl
+        return bool(await self.client.set(key, value, ex=ttl, nx=True))
 
-    async def delete_by_pattern(self, pattern: str) -> None:
-        pipe = self.client.pipeline(transaction=True)
-        async for key in self.client.scan_iter(match=pattern):
-            await pipe.delete(key)
-        await pipe.execute(raise_on_error=True)
-        return
+    async def delete(self, *keys) -> bool:
+        return await self.client.delete(*keys)
+
+    async def set_tagged(
+        self,
+        key,
+        value,
+        tag: str,
+        ttl: int | None = None,
+        guard: tuple[str, str] | None = None,
+    ) -> bool:
+        # With a guard (key, expected value) nothing is written once the key moved on
+        ttl = self.client_cache_ttl if ttl is None else ttl
+        keys, args = [key, tag], [value, ttl]
+        if guard is not None:
+            keys.append(guard[0])
+            args.append(guard[1])
+        return bool(
+            await self.eval_script(self.set_tagged_script, keys=keys, args=args)
+        )
+
+    async def delete_by_tag(self, tag: str) -> int:
+        return await self.eval_script(self.delete_by_tag_script, keys=[tag], args=[])
+
+    async def get_by_tag(self, tag: str) -> list[str]:
+        # Replaces get_by_pattern, members deleted outside the tag are skipped
+        return await self.eval_script(self.get_by_tag_script, keys=[tag], args=[])
 
     async def get(self, key):
         value = await self.client.get(key)
         return value
 
-    async def get_by_pattern(self, pattern: str) -> list[str]:
+    async def get_with_ttl(self, key: str) -> tuple[str | None, int]:
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.ttl(key)
+        value, ttl = await pipe.execute(raise_on_error=True)
+        return value, ttl
+
+    async def increment(self, key: str, ttl: int | None = None) -> int:
+        ttl = self.client_cache_ttl if ttl is None else ttl
+        pipe = self.client.pipeline(transaction=True)
+        pipe.incr(key)
+        pipe.expire(key, ttl)
+        value, _ = await pipe.execute(raise_on_error=True)
+        return value
+
+    async def time(self) -> float:
+        seconds, microseconds = await self.client.time()
+        return seconds + microseconds / 1_000_000
+
+    async def exists(self, key: str) -> bool:
+        return bool(await self.client.exists(key))
+
+    async def get_many(self, keys: list[str]) -> list[str | None]:
+        if not keys:
+            return []
+        return await self.client.mget(keys)
+
+    async def set_many(self, mapping: dict[str, str], ttl: int | None = None) -> None:
+        ttl = self.client_cache_ttl if ttl is None else ttl
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(key, value, ex=ttl)
+        await pipe.execute(raise_on_error=True)
+        return
+
+    async def hash_get(self, key: str, field: str) -> str | None:
+        return await self.client.hget(key, field)
+
+    async def hash_set(self, key: str, mapping: dict[str, str]) -> int:
+        if not mapping:
+            return 0
+        return await self.client.hset(key, mapping=mapping)
+
+    async def hash_delete(self, key: str, *fields: str) -> int:
+        return await self.client.hdel(key, *fields)
+
+    async def get_list(self, key: str) -> list[str]:
+        return await self.client.lrange(key, 0, -1)
+
+    async def list_length(self, key: str) -> int:
+        return await self.client.llen(key)
+
+    async def replace_list(
+        self, key: str, values: list[str], ttl: int | None = None
+    ) -> None:
+        ttl = self.client_cache_ttl if ttl is None else ttl
+        async with self.redis_transaction() as pipe:
+            pipe.delete(key)
+            if values:
+                pipe.rpush(key, *values)
+                pipe.expire(key, ttl)
+        return
+
+    async def append_list_if_exists(
+        self, key: str, values: list[str], ttl: int | None = None
+    ) -> int:
+        ttl = self.client_cache_ttl if ttl is None else ttl
         pipe = self.client.pipeline(transaction=True)
-        async for key in self.client.scan_iter(match=pattern):
-            await pipe.get(key)
-        return await pipe.execute(raise_on_error=True)
+        pipe.rpushx(key, *values)
+        pipe.expire(key, ttl)
+        length, _ = await pipe.execute(raise_on_error=True)
+        return length
+
+    def lock(
+        self, key: str, timeout: float, blocking_timeout: float | None = None
+    ) -> Lock:
+        return self.client.lock(key, timeout=timeout, blocking_timeout=blocking_timeout)
+
+    @asynccontextmanager
+    async def renewing(self, lock: Lock) -> AsyncIterator[None]:
+        # Keeps an acquired lock from expiring for as long as the block runs
+        async def renew() -> None:
+            while True:
+                await asyncio.sleep(lock.timeout / 3)
+                try:
+                    await lock.reacquire()
+                except Exception as generic_error:
+                    logging.error(f"Redis lock renewal error: {generic_error}")
+                    return
+
+        renewal = asyncio.create_task(renew())
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            await asyncio.gather(renewal, return_exceptions=True)
+
+    async def eval_script(self, script: str, keys: list[str], args: list) -> Any:
+        registered_script = self.scripts.get(script)
+        if registered_script is None:
+            registered_script = self.client.register_script(script)
+            self.scripts[script] = registered_script
+        return await registered_script(keys=keys, args=args)
+
+    async def stream_add(self, stream: str, fields: dict[str, str]) -> str:
+        return await self.client.xadd(stream, fields)
+
+    async def stream_delete(self, stream: str, *entry_ids: str) -> int:
+        return await self.client.xdel(stream, *entry_ids)
+
+    async def stream_range(
+        self, stream: str, min: str = "-", max: str = "+", count: int | None = None
+    ) -> list[tuple[str, dict[str, str]]]:
+        return await self.client.xrange(stream, min=min, max=max, count=count)
+
+    async def publish(self, channel: str, message: str) -> int:
+        return await self.client.publish(channel, message)
+
+    async def subscribe(self, channel: str) -> AsyncIterator[str]:
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(channel)
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield message["data"]
+        finally:
+            await pubsub.close()
 
     async def clear(self):
         return await self.client.flushdb()
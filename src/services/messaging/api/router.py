@@ -1,5 +1,5 @@
 import aiohttp
-from fastapi import APIRouter, Depends, Body, Query, status, Path
+from fastapi import APIRouter, Depends, Body, Header, Query, Response, status, Path
 from pydantic import UUID4
 from ..schemas.chat import (
     CreateChat,
@@ -11,7 +11,8 @@ from ..schemas.chat import (
 from ..schemas.user import UserCredentials
 from .dependencies import get_messaging_service
 from ..service.messaging import MessagingService
-from src.dependencies import parse_jwt_bearer, get_aiohttp_session
+from src.dependencies import parse_jwt_bearer, get_aiohttp_session, limit_reads
+from src.idempotency import idempotency_store
 from src.schemas import JWTPayload
 from typing import Annotated
 
@@ -20,16 +21,18 @@ router = APIRouter(prefix="/messaging", tags=["Messaging (Chats & History)"])
 
 @router.post(
     "/chat",
-    description="Создание чата для беседы с ИИ",
+    description="Создание чата для беседы с ИИ. С заголовком Idempotency-Key повторный запрос возвращает уже созданный чат (заголовок Idempotent-Replayed: true)",
     status_code=status.HTTP_201_CREATED,
     response_model=ChatPayload,
 )
 async def chat_creation(
+    response: Response,
     jwt_payload: Annotated[JWTPayload, Depends(parse_jwt_bearer)],
     session: Annotated[aiohttp.ClientSession, Depends(get_aiohttp_session)],
     messaging_service: Annotated[MessagingService, Depends(get_messaging_service)],
     vault_id: Annotated[UUID4, Body()] = "1897e0cd88ee4b86a053972d05212a21",
     name: Annotated[str, Body(max_length=100)] = "Беседа по железобетону",
+    idempotency_key: Annotated[str | None, Header(max_length=255)] = None,
 ):
     chat_creation_credentials = CreateChat(
         user_id=jwt_payload.user_id,
@@ -37,14 +40,30 @@ async def chat_creation(
         name=name,
     )
 
-    chat_payload = await messaging_service.create_chat(
-        create_chat_credentials=chat_creation_credentials, session=session
+    def create_chat():
+        return messaging_service.create_chat(
+            create_chat_credentials=chat_creation_credentials, session=session
+        )
+
+    if idempotency_key is None:
+        return await create_chat()
+
+    chat_payload, replayed = await idempotency_store.execute(
+        scope="chat_creation",
+        user_id=jwt_payload.user_id,
+        idempotency_key=idempotency_key,
+        fingerprint=chat_creation_credentials.model_dump_json(),
+        model=ChatPayload,
+        call=create_chat,
     )
+    if replayed:
+        response.headers["idempotent-replayed"] = "true"
     return chat_payload
 
 
 @router.get(
     "/chats/preview",
+    dependencies=[Depends(limit_reads)],
     response_model=list[ChatPayload],
     description="Получение чатов пользователя (архивированные или нет). Если нужны архивированные - то передайте параметр is_archived=true (get_user_chats?is_archived=true). **ЧАТЫ БЕЗ ИСТОРИИ**",
 )
@@ -64,7 +83,7 @@ async def getting_user_chats(
 @router.get(
     "/chat/{chat_id}",
     response_model=ChatPayload,
-    dependencies=[Depends(parse_jwt_bearer)],
+    dependencies=[Depends(parse_jwt_bearer), Depends(limit_reads)],
     description="Получение определённого чата по ID, **ВКЛЮЧАЯ ИСТОРИЮ**",
 )
 async def getting_particular_chat(
@@ -23,15 +23,33 @@ class HistoryServiceSettings(BaseSettings):
     )
     history_service_host: str
     history_service_port: int
+    # After /add_exchange turned out missing, it is probed again once this is over
+    history_exchange_reprobe_interval: float = 5 * 60
 
     @property
     def history_service_url(self) -> HttpUrl:
         return f"http://{self.history_service_host}:{self.history_service_port}"
 
 
+class HistoryWriterSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file=MESSAGING_SERVICE_DIR / ".env", extra="ignore"
+    )
+    history_writer_partitions: int = 8
+    history_writer_max_retries: int = 5
+    history_writer_retry_delay: float = 0.5
+    history_writer_drain_timeout: float = 30
+    history_writer_recovery_age: int = 15 * 60
+    history_writer_sweep_interval: int = 60
+    history_writer_lock_timeout: float = 30
+    # Has to outlive every write journaled before a history was cleaned
+    history_writer_fence_ttl: int = 60 * 60 * 24
+
+
 class Setting(BaseModel):
     chats_service_settings: ChatsServiceSettings = ChatsServiceSettings()
     history_service_settings: HistoryServiceSettings = HistoryServiceSettings()
+    history_writer_settings: HistoryWriterSettings = HistoryWriterSettings()
 
 
 settings = Setting()
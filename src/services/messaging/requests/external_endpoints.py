@@ -21,6 +21,7 @@ class HistoryEndpoints(BaseModel):
     create_message: str = f"{HISTORY_SERVICE_URL}/create_history"
     add_user_message: str = f"{HISTORY_SERVICE_URL}/add_user_message"
     add_ai_message: str = f"{HISTORY_SERVICE_URL}/add_ai_message"
+    add_exchange: str = f"{HISTORY_SERVICE_URL}/add_exchange"
     clear_history: str = f"{HISTORY_SERVICE_URL}/clear_history"
     delete_history: str = f"{HISTORY_SERVICE_URL}/delete_history"
     get_history: str = f"{HISTORY_SERVICE_URL}/get_history"
@@ -4,5 +4,7 @@ from .update import (
     clean_history_request,
     add_ai_message_request,
     add_user_message_request,
+    add_exchange_request,
+    ExchangeUnsupported,
 )
 from .delete import delete_history_request
@@ -1,10 +1,26 @@
+import logging
+import time
 import aiohttp
-from fastapi import HTTPException
+from fastapi import HTTPException, status
 from src.utils import aiohttp_error_handler
 from ...schemas.chat import ChatCredentials
-from ...schemas.history import AddUserMessage, AddAIMessage
+from ...schemas.history import AddUserMessage, AddAIMessage, AddExchange
+from ...config import settings
 from ..external_endpoints import history_endpoints
 
+# Set once the history service turns out not to know /add_exchange, the endpoint
+# is probed again when it has passed, e.g. after the service was upgraded
+add_exchange_unsupported_until = 0.0
+
+
+class ExchangeUnsupported(HTTPException):
+    # Raised before anything is written, the caller writes the two messages itself
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_501_NOT_IMPLEMENTED,
+            detail="History service does not support exchanges",
+        )
+
 
 @aiohttp_error_handler(service_name="History")
 async def clean_history_request(
@@ -27,10 +43,12 @@ async def add_user_message_request(
     session: aiohttp.ClientSession,
     pydantic_model: AddUserMessage,
     endpoint: str = history_endpoints.add_user_message,
+    idempotency_key: str | None = None,
 ) -> None:
+    headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
     json_data = pydantic_model.model_dump(mode="json")
 
-    async with session.post(url=endpoint, json=json_data) as response:
+    async with session.post(url=endpoint, headers=headers, json=json_data) as response:
         result = await response.json()
         if response.status >= 400:
             raise HTTPException(status_code=response.status, detail=result["detail"])
@@ -43,12 +61,54 @@ async def add_ai_message_request(
     session: aiohttp.ClientSession,
     pydantic_model: AddAIMessage,
     endpoint: str = history_endpoints.add_ai_message,
+    idempotency_key: str | None = None,
 ) -> None:
+    headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
     json_data = pydantic_model.model_dump(mode="json")
 
-    async with session.post(url=endpoint, json=json_data) as response:
+    async with session.post(url=endpoint, headers=headers, json=json_data) as response:
         result = await response.json()
         if response.status >= 400:
             raise HTTPException(status_code=response.status, detail=result["detail"])
 
     return
+
+
+@aiohttp_error_handler(service_name="History")
+async def add_exchange_request(
+    session: aiohttp.ClientSession,
+    pydantic_model: AddExchange,
+    endpoint: str = history_endpoints.add_exchange,
+    idempotency_key: str | None = None,
+) -> None:
+    global add_exchange_unsupported_until
+
+    if time.monotonic() < add_exchange_unsupported_until:
+        raise ExchangeUnsupported()
+
+    headers = {"Idempotency-Key": idempotency_key} if idempotency_key else None
+    json_data = pydantic_model.model_dump(mode="json")
+
+    async with session.post(url=endpoint, headers=headers, json=json_data) as response:
+        if response.status < 400:
+            return
+        # A missing route may answer with plain text or HTML instead of JSON
+        try:
+            detail = (await response.json())["detail"]
+            route_missing = detail == "Not Found"
+        except (aiohttp.ContentTypeError, ValueError, KeyError, TypeError):
+            detail = await response.text()
+            route_missing = True
+        unsupported = response.status in (
+            status.HTTP_405_METHOD_NOT_ALLOWED,
+            status.HTTP_501_NOT_IMPLEMENTED,
+        ) or (response.status == status.HTTP_404_NOT_FOUND and route_missing)
+        if not unsupported:
+            raise HTTPException(status_code=response.status, detail=detail)
+
+    add_exchange_unsupported_until = (
+        time.monotonic()
+        + settings.history_service_settings.history_exchange_reprobe_interval
+    )
+    logging.warning("History service does not support exchanges, using two calls")
+    raise ExchangeUnsupported()
@@ -31,6 +31,11 @@ class AddAIMessage(BaseAddMessage):
     message: AIMessage
 
 
+class AddExchange(BaseAddMessage):
+    user_message: UserMessage
+    ai_message: AIMessage
+
+
 class BaseMessageResponse(BaseMessage):
     role: str
 
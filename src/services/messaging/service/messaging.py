@@ -31,6 +31,8 @@ from ..schemas.history import HistoryPayload
 from ..schemas.user import UserCredentials
 from ..requests.external_endpoints import chats_endpoints
 from ..utils.cache import messaging_cache_manager
+from ..utils.history_writer import history_writer
+from src.single_flight import single_flight
 
 
 class MessagingService:
@@ -43,27 +45,52 @@ class MessagingService:
         chat_credentials: ChatCredentials,
     ) -> ChatPayload:
         chat_payload = await self.cache_manager.get_chat(
-            chat_id=chat_credentials.chat_id
+            chat_id=chat_credentials.chat_id,
+            refresh=lambda: self.fetch_chat(
+                session=session, chat_credentials=chat_credentials
+            ),
         )
 
         if chat_payload is None:
-            get_chat_request_task = get_chat_request(
-                session=session,
-                pydantic_model=chat_credentials,
-            )
-            get_history_request_task = get_history_request(
-                session=session, pydantic_model=chat_credentials
+            chat_payload = await single_flight.do(
+                key=f"messaging:chat:{chat_credentials.chat_id.hex}",
+                load_cached=lambda: self.cache_manager.get_chat(
+                    chat_id=chat_credentials.chat_id
+                ),
+                fetch=lambda: self.fetch_chat(
+                    session=session, chat_credentials=chat_credentials
+                ),
             )
 
-            chat_payload, history_payload = await asyncio.gather(
-                get_chat_request_task, get_history_request_task
-            )
+        return chat_payload
 
-            chat_payload.chat_history = history_payload
-            await self.cache_manager.set_chat(
-                chat_id=chat_credentials.chat_id, chat_payload=chat_payload
-            )
+    async def fetch_chat(
+        self,
+        session: aiohttp.ClientSession,
+        chat_credentials: ChatCredentials,
+    ) -> ChatPayload:
+        # Read first, so writes that land during the fetch keep the snapshot out
+        history_version = await self.cache_manager.get_history_version(
+            chat_id=chat_credentials.chat_id
+        )
+        get_chat_request_task = get_chat_request(
+            session=session,
+            pydantic_model=chat_credentials,
+        )
+        get_history_request_task = get_history_request(
+            session=session, pydantic_model=chat_credentials
+        )
 
+        chat_payload, history_payload = await asyncio.gather(
+            get_chat_request_task, get_history_request_task
+        )
+
+        chat_payload.chat_history = history_payload
+        await self.cache_manager.set_chat(
+            chat_id=chat_credentials.chat_id,
+            chat_payload=chat_payload,
+            history_version=history_version,
+        )
         return chat_payload
 
     async def get_chats_by_user_id(
@@ -73,28 +100,47 @@ class MessagingService:
         is_archived: bool,
     ) -> list[ChatPayload]:
         chat_payloads = await self.cache_manager.get_chats(
-            id=user_credentials.user_id, is_archived=is_archived
+            id=user_credentials.user_id,
+            is_archived=is_archived,
+            refresh=lambda: self.fetch_user_chats(
+                session=session,
+                user_credentials=user_credentials,
+                is_archived=is_archived,
+            ),
         )
         if chat_payloads is None:
-            endpoint = (
-                chats_endpoints.get_user_chats
-                if not is_archived
-                else chats_endpoints.get_user_archived_chats
-            )
-
-            chat_payloads = await get_user_chats_request(
+            chat_payloads = await self.fetch_user_chats(
                 session=session,
-                pydantic_model=user_credentials,
-                endpoint=endpoint,
-            )
-
-            await self.cache_manager.set_chats(
-                id=user_credentials.user_id,
+                user_credentials=user_credentials,
                 is_archived=is_archived,
-                chat_payloads=chat_payloads,
             )
         return chat_payloads
 
+    async def fetch_user_chats(
+        self,
+        session: aiohttp.ClientSession,
+        user_credentials: UserCredentials,
+        is_archived: bool,
+    ) -> list[ChatPayload]:
+        endpoint = (
+            chats_endpoints.get_user_chats
+            if not is_archived
+            else chats_endpoints.get_user_archived_chats
+        )
+
+        chat_payloads = await get_user_chats_request(
+            session=session,
+            pydantic_model=user_credentials,
+            endpoint=endpoint,
+        )
+
+        await self.cache_manager.set_chats(
+            id=user_credentials.user_id,
+            is_archived=is_archived,
+            chat_payloads=chat_payloads,
+        )
+        return chat_payloads
+
     async def get_chats_by_vault_id(
         self,
         session: aiohttp.ClientSession,
@@ -132,7 +178,7 @@ class MessagingService:
             pydantic_model=change_archive_status_credentials,
             endpoint=endpoint,
         )
-        await self.cache_manager.delete_chat(
+        await self.cache_manager.delete_chat_meta(
             chat_id=change_archive_status_credentials.chat_id
         )
         await self.cache_manager.delete_chats(id=user_id)
@@ -141,10 +187,12 @@ class MessagingService:
     async def clean_chat_history(
         self, chat_credentials: ChatCredentials, session: aiohttp.ClientSession
     ) -> None:
-        await clean_history_request(
-            session=session,
-            pydantic_model=chat_credentials,
-        )
+        # Writes still queued for the chat would bring the history back
+        async with history_writer.fence(chat_id=chat_credentials.chat_id):
+            await clean_history_request(
+                session=session,
+                pydantic_model=chat_credentials,
+            )
         await self.cache_manager.delete_chat(chat_id=chat_credentials.chat_id)
         return
 
@@ -240,16 +288,29 @@ class MessagingService:
             session=session,
             pydantic_model=chat_update_credentials,
         )
-        await self.cache_manager.delete_chat(chat_id=chat_update_credentials.chat_id)
+        await self.cache_manager.delete_chat_meta(
+            chat_id=chat_update_credentials.chat_id
+        )
         await self.cache_manager.delete_chats(id=user_id)
         return
 
-    @staticmethod
     async def get_chat_history(
+        self,
         chat_credentials: ChatCredentials,
         session: aiohttp.ClientSession,
     ) -> HistoryPayload:
-        history = await get_history_request(
-            session=session, pydantic_model=chat_credentials
-        )
+        history = await self.cache_manager.get_history(chat_id=chat_credentials.chat_id)
+        if history is None:
+            # Upstream history lags behind queued writes, so only a settled one is cached
+            history_version = await self.cache_manager.get_history_version(
+                chat_id=chat_credentials.chat_id
+            )
+            history = await get_history_request(
+                session=session, pydantic_model=chat_credentials
+            )
+            await self.cache_manager.set_history(
+                chat_id=chat_credentials.chat_id,
+                history_payload=history,
+                version=history_version,
+            )
         return history
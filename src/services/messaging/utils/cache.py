@@ -1,56 +1,210 @@
+import asyncio
 import uuid
+from typing import Awaitable, Callable
 from ..schemas.chat import ChatPayload
 import json
+from src.config import settings, CacheTTL
 from src.repositories.redis import RedisRepository
+from src.local_cache import local_cache
+from src.single_flight import single_flight
 from ..schemas.history import UserMessageResponse, AIMessageResponse, HistoryPayload
 
 
 class MessagingCache:
-    def __init__(self, redis_repository: type(RedisRepository)):
+    # The history state hash counts writes still on their way to the history
+    # service and bumps "generation" whenever one is queued or finished
+    history_write_script = """
+    local pending = tonumber(redis.call('HGET', KEYS[1], 'pending') or '0')
+    pending = math.max(0, pending + tonumber(ARGV[1]))
+    redis.call('HSET', KEYS[1], 'pending', pending)
+    redis.call('HINCRBY', KEYS[1], 'generation', 1)
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return pending
+    """
+    # An upstream snapshot is only cached if no write was queued or finished
+    # since its generation was read
+    replace_history_script = """
+    local state = redis.call('HMGET', KEYS[2], 'generation', 'pending')
+    if (state[1] or '0') ~= ARGV[1] or tonumber(state[2] or '0') > 0 then
+        return 0
+    end
+    redis.call('DEL', KEYS[1])
+    redis.call('RPUSH', KEYS[1], unpack(ARGV, 3))
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+    """
+
+    def __init__(
+        self, redis_repository: type(RedisRepository), ttls: dict[str, CacheTTL]
+    ):
         self.redis: RedisRepository = redis_repository()
+        self.ttls = ttls
         self.cache_prefix = "messaging:"
         self.chat_prefix = "chat:"
         self.chats_prefix = "chats:"
+        self.history_prefix = "history:"
+        self.history_state_prefix = "history_state:"
 
-    async def get_chat(self, chat_id: uuid.UUID) -> None | ChatPayload:
-        result = await self.redis.get(
-            f"{self.cache_prefix}{self.chat_prefix}{chat_id.hex}"
+    # History is written through, so the chat key alone decides whether it is stale
+    async def get_chat(
+        self,
+        chat_id: uuid.UUID,
+        refresh: Callable[[], Awaitable] | None = None,
+    ) -> None | ChatPayload:
+        key = f"{self.cache_prefix}{self.chat_prefix}{chat_id.hex}"
+        chat_payload, history_payload = await asyncio.gather(
+            local_cache.get(
+                key,
+                load=lambda: single_flight.get_revalidating(
+                    key, cache_ttl=self.ttls["chat"], refresh=refresh
+                ),
+                parse=ChatPayload.model_validate_json,
+            ),
+            self.get_history(chat_id=chat_id),
         )
+        if chat_payload is None or history_payload is None:
+            return None
 
-        json_result = json.loads(result) if result else None
-        processed_history = []
-        if json_result is not None:
-            for history in json_result["chat_history"]["history"]:
-                if history["role"] == "user":
-                    processed_history.append(UserMessageResponse(**history))
-                else:
-                    processed_history.append(AIMessageResponse(**history))
-            history_payload = HistoryPayload(history=processed_history)
-            chat_payload = ChatPayload.model_validate_json(result)
-            chat_payload.chat_history = history_payload
-            return chat_payload
-        else:
+        # The payload kept in the local cache is shared, it must not be modified
+        return chat_payload.model_copy(update={"chat_history": history_payload})
+
+    async def set_chat(
+        self,
+        chat_id: uuid.UUID,
+        chat_payload: ChatPayload,
+        history_version: str | None = None,
+    ) -> bool:
+        str_chat_payload = chat_payload.model_dump_json(exclude={"chat_history"})
+        if chat_payload.chat_history is not None:
+            await self.set_history(
+                chat_id=chat_id,
+                history_payload=chat_payload.chat_history,
+                version=history_version,
+            )
+        key = f"{self.cache_prefix}{self.chat_prefix}{chat_id.hex}"
+        local_cache.drop(key)
+        return await self.redis.set(key, str_chat_payload, ttl=self.ttls["chat"].hard)
+
+    async def delete_chat_meta(self, chat_id: uuid.UUID) -> bool:
+        # Leaves the cached history alone, e.g. for a rename
+        key = f"{self.cache_prefix}{self.chat_prefix}{chat_id.hex}"
+        deleted = await self.redis.delete(key)
+        await local_cache.invalidate(key)
+        return deleted
+
+    async def delete_chat(self, chat_id: uuid.UUID) -> bool:
+        key = f"{self.cache_prefix}{self.chat_prefix}{chat_id.hex}"
+        deleted = await self.redis.delete(
+            key, f"{self.cache_prefix}{self.history_prefix}{chat_id.hex}"
+        )
+        await local_cache.invalidate(key)
+        return deleted
+
+    # The history list starts with an empty sentinel so that an empty history is still cached
+    async def get_history(self, chat_id: uuid.UUID) -> None | HistoryPayload:
+        result = await self.redis.get_list(
+            f"{self.cache_prefix}{self.history_prefix}{chat_id.hex}"
+        )
+        if not result:
             return None
 
-    async def set_chat(self, chat_id: uuid.UUID, chat_payload: ChatPayload) -> bool:
-        str_chat_payload = chat_payload.model_dump_json()
-        return await self.redis.set(
-            f"{self.cache_prefix}{self.chat_prefix}{chat_id.hex}", str_chat_payload
+        processed_history = []
+        for message in result[1:]:
+            json_message = json.loads(message)
+            if json_message["role"] == "user":
+                processed_history.append(UserMessageResponse(**json_message))
+            else:
+                processed_history.append(AIMessageResponse(**json_message))
+        return HistoryPayload(history=processed_history)
+
+    async def set_history(
+        self,
+        chat_id: uuid.UUID,
+        history_payload: HistoryPayload,
+        version: str | None = None,
+    ) -> bool:
+        key = f"{self.cache_prefix}{self.history_prefix}{chat_id.hex}"
+        values = [""] + [
+            message.model_dump_json() for message in history_payload.history
+        ]
+        if version is None:
+            await self.redis.replace_list(key, values, ttl=self.ttls["chat"].hard)
+            return True
+        return bool(
+            await self.redis.eval_script(
+                self.replace_history_script,
+                keys=[key, self.make_history_state_key(chat_id)],
+                args=[version, self.ttls["chat"].hard, *values],
+            )
         )
 
-    async def delete_chat(self, chat_id: uuid.UUID) -> bool:
-        return await self.redis.delete(
-            f"{self.cache_prefix}{self.chat_prefix}{chat_id.hex}"
+    def make_history_state_key(self, chat_id: uuid.UUID) -> str:
+        return f"{self.cache_prefix}{self.history_state_prefix}{chat_id.hex}"
+
+    async def get_history_version(self, chat_id: uuid.UUID) -> str:
+        generation = await self.redis.hash_get(
+            self.make_history_state_key(chat_id), "generation"
         )
+        return generation or "0"
+
+    async def begin_history_write(self, chat_id: uuid.UUID) -> None:
+        await self.redis.eval_script(
+            self.history_write_script,
+            keys=[self.make_history_state_key(chat_id)],
+            args=[1, self.ttls["chat"].hard],
+        )
+        return
+
+    async def end_history_write(self, chat_id: uuid.UUID) -> None:
+        await self.redis.eval_script(
+            self.history_write_script,
+            keys=[self.make_history_state_key(chat_id)],
+            args=[-1, self.ttls["chat"].hard],
+        )
+        return
+
+    async def has_history(self, chat_id: uuid.UUID) -> bool:
+        return await self.redis.exists(
+            f"{self.cache_prefix}{self.history_prefix}{chat_id.hex}"
+        )
+
+    async def get_history_length(self, chat_id: uuid.UUID) -> int | None:
+        length = await self.redis.list_length(
+            f"{self.cache_prefix}{self.history_prefix}{chat_id.hex}"
+        )
+        return length - 1 if length else None
+
+    async def append_history(
+        self,
+        chat_id: uuid.UUID,
+        messages: list[UserMessageResponse | AIMessageResponse],
+    ) -> bool:
+        length = await self.redis.append_list_if_exists(
+            f"{self.cache_prefix}{self.history_prefix}{chat_id.hex}",
+            [message.model_dump_json() for message in messages],
+            ttl=self.ttls["chat"].hard,
+        )
+        return length > 0
 
     # Use just id not user_id because we also can store payloads by vault_id
     async def get_chats(
-        self, id: uuid.UUID, is_archived: bool
+        self,
+        id: uuid.UUID,
+        is_archived: bool,
+        refresh: Callable[[], Awaitable] | None = None,
     ) -> None | list[ChatPayload]:
-        result = await self.redis.get(
-            f"{self.cache_prefix}{self.chats_prefix}{id.hex}:{is_archived}"
+        key = f"{self.cache_prefix}{self.chats_prefix}{id.hex}:{is_archived}"
+        return await local_cache.get(
+            key,
+            load=lambda: single_flight.get_revalidating(
+                key, cache_ttl=self.ttls["chats"], refresh=refresh
+            ),
+            parse=self.parse_chats,
         )
-        json_result = json.loads(result) if result else None
+
+    @staticmethod
+    def parse_chats(result: str) -> None | list[ChatPayload]:
+        json_result = json.loads(result)
         chat_payloads = (
             [ChatPayload.model_validate_json(chat) for chat in json_result]
             if json_result
@@ -65,16 +219,21 @@ class MessagingCache:
             chat_payload.model_dump_json() for chat_payload in chat_payloads
         ]
         json_chat_payloads = json.dumps(str_chat_payloads)
+        key = f"{self.cache_prefix}{self.chats_prefix}{id.hex}:{is_archived}"
+        local_cache.drop(key)
         return await self.redis.set(
-            f"{self.cache_prefix}{self.chats_prefix}{id.hex}:{is_archived}",
-            json_chat_payloads,
+            key, json_chat_payloads, ttl=self.ttls["chats"].hard
         )
 
+    # Both lists of an id are known, so they are deleted without a tag set
     async def delete_chats(self, id: uuid.UUID) -> None:
-        await self.redis.delete_by_pattern(
-            pattern=f"{self.cache_prefix}{self.chats_prefix}{id.hex}:*"
-        )
+        keys = [
+            f"{self.cache_prefix}{self.chats_prefix}{id.hex}:{is_archived}"
+            for is_archived in (False, True)
+        ]
+        await self.redis.delete(*keys)
+        await local_cache.invalidate(*keys)
         return
 
 
-messaging_cache_manager = MessagingCache(RedisRepository)
+messaging_cache_manager = MessagingCache(RedisRepository, ttls=settings.cache_ttls)
@@ -0,0 +1,440 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+import aiohttp
+from fastapi import HTTPException, status
+from redis.exceptions import LockError
+from src.metrics import metrics
+from src.repositories.redis import RedisRepository
+from ..config import settings
+from ..requests.history_service import (
+    add_user_message_request,
+    add_ai_message_request,
+    add_exchange_request,
+    ExchangeUnsupported,
+)
+from ..schemas.history import (
+    AddUserMessage,
+    AddAIMessage,
+    AddExchange,
+    UserMessage,
+    AIMessage,
+    UserMessageResponse,
+    AIMessageResponse,
+)
+from .cache import messaging_cache_manager
+
+HistoryWrite = AddUserMessage | AddAIMessage | AddExchange
+HISTORY_WRITE_MODELS = {
+    "user": AddUserMessage,
+    "ai": AddAIMessage,
+    "exchange": AddExchange,
+}
+HISTORY_WRITE_KINDS = {model: kind for kind, model in HISTORY_WRITE_MODELS.items()}
+
+
+class HistoryWriteFenced(HTTPException):
+    # Journaled before the history of the chat was cleaned, so it is dropped
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Chat history was cleaned after this write was queued",
+        )
+
+
+class HistoryWriter:
+    def __init__(
+        self,
+        redis_repository: type(RedisRepository),
+        partitions: int,
+        max_retries: int,
+        retry_delay: float,
+        drain_timeout: float,
+        recovery_age: int,
+        sweep_interval: int,
+        lock_timeout: float,
+        fence_ttl: int,
+    ):
+        self.redis: RedisRepository = redis_repository()
+        self.stream = "messaging:history_writes"
+        self.recovery_lease = "messaging:history_writes:recovery"
+        self.lock_prefix = "messaging:history_write_lock:"
+        self.fence_prefix = "messaging:history_fence:"
+        self.partitions = partitions
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.drain_timeout = drain_timeout
+        self.recovery_age = recovery_age
+        self.sweep_interval = sweep_interval
+        self.lock_timeout = lock_timeout
+        self.fence_ttl = fence_ttl
+        self.session: aiohttp.ClientSession | None = None
+        self.queues: list[asyncio.Queue] = []
+        self.workers: list[asyncio.Task] = []
+        self.pending: Counter[uuid.UUID] = Counter()
+        # Journal entries queued in this process, the sweep leaves them alone
+        self.queued: set[str] = set()
+        # Writes of chats whose oldest write keeps failing, held back in order
+        self.held: dict[uuid.UUID, deque[tuple[str | None, HistoryWrite]]] = dict()
+        self.releases: set[asyncio.Task] = set()
+        self.written = asyncio.Condition()
+
+    def start(self, session: aiohttp.ClientSession) -> None:
+        self.session = session
+        self.queues = [asyncio.Queue() for _ in range(self.partitions)]
+        self.workers = [asyncio.create_task(self.work(queue)) for queue in self.queues]
+        self.workers.append(asyncio.create_task(self.recover()))
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def has_pending(self, chat_id: uuid.UUID) -> bool:
+        return self.pending[chat_id] > 0
+
+    async def flushed(self, chat_id: uuid.UUID) -> None:
+        async with self.written:
+            await self.written.wait_for(lambda: not self.has_pending(chat_id))
+
+    def put(self, entry_id: str | None, message: HistoryWrite) -> None:
+        self.pending[message.chat_id] += 1
+        if entry_id is not None:
+            self.queued.add(entry_id)
+        # Messages of one chat always land in the same partition, which keeps them in order
+        self.queues[message.chat_id.int % self.partitions].put_nowait(
+            (entry_id, message)
+        )
+        metrics.set_gauge("messaging.history_writer.queue_depth", self.queue_depth)
+
+    async def enqueue(self, message: HistoryWrite) -> None:
+        entry_id = None
+        try:
+            entry_id = await self.redis.stream_add(
+                self.stream,
+                {
+                    "kind": HISTORY_WRITE_KINDS[type(message)],
+                    "payload": message.model_dump_json(),
+                },
+            )
+        except Exception as generic_error:
+            logging.error(f"History write is not journaled: {generic_error}")
+        await self.begin(chat_id=message.chat_id)
+        self.put(entry_id, message)
+
+        # Keep a cached history hot by appending the messages it is about to receive
+        try:
+            await messaging_cache_manager.append_history(
+                chat_id=message.chat_id, messages=self.to_responses(message)
+            )
+        except Exception as generic_error:
+            logging.error(f"History writer cache error: {generic_error}")
+            await self.invalidate(chat_id=message.chat_id)
+        return
+
+    @staticmethod
+    def to_responses(
+        message: HistoryWrite,
+    ) -> list[UserMessageResponse | AIMessageResponse]:
+        if isinstance(message, AddUserMessage):
+            return [UserMessageResponse(**message.message.model_dump(), role="user")]
+        if isinstance(message, AddAIMessage):
+            return [AIMessageResponse(**message.message.model_dump(), role="ai")]
+        return [
+            UserMessageResponse(**message.user_message.model_dump(), role="user"),
+            AIMessageResponse(**message.ai_message.model_dump(), role="ai"),
+        ]
+
+    async def add_user_message(self, chat_id: uuid.UUID, message: UserMessage) -> None:
+        await self.enqueue(AddUserMessage(chat_id=chat_id, message=message))
+
+    async def add_ai_message(self, chat_id: uuid.UUID, message: AIMessage) -> None:
+        await self.enqueue(AddAIMessage(chat_id=chat_id, message=message))
+
+    async def add_exchange(
+        self, chat_id: uuid.UUID, user_message: UserMessage, ai_message: AIMessage
+    ) -> None:
+        await self.enqueue(
+            AddExchange(
+                chat_id=chat_id, user_message=user_message, ai_message=ai_message
+            )
+        )
+
+    def make_lock(self, chat_id: uuid.UUID):
+        return self.redis.lock(
+            f"{self.lock_prefix}{chat_id.hex}",
+            timeout=self.lock_timeout,
+            blocking_timeout=self.lock_timeout,
+        )
+
+    @asynccontextmanager
+    async def fence(self, chat_id: uuid.UUID) -> AsyncIterator[None]:
+        # Writes of the chat journaled before this point are dropped instead of
+        # written, the lock waits out a write that is already running
+        lock = self.make_lock(chat_id)
+        if not await lock.acquire():
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Chat history is being written, try again later",
+            )
+        try:
+            async with self.redis.renewing(lock):
+                fenced_at = int(await self.redis.time() * 1000)
+                await self.redis.set(
+                    f"{self.fence_prefix}{chat_id.hex}", fenced_at, ttl=self.fence_ttl
+                )
+                yield
+        finally:
+            await self.release_lock(lock)
+
+    async def is_fenced(self, chat_id: uuid.UUID, idempotency_key: str | None) -> bool:
+        # The key starts with the journal entry id, whose first part is a timestamp
+        if idempotency_key is None:
+            return False
+        fenced_at = await self.redis.get(f"{self.fence_prefix}{chat_id.hex}")
+        return fenced_at is not None and (
+            int(idempotency_key.split("-")[0]) <= int(fenced_at)
+        )
+
+    @staticmethod
+    async def release_lock(lock) -> None:
+        try:
+            await lock.release()
+        except LockError as lock_error:
+            logging.error(f"History write lock expired before release: {lock_error}")
+
+    async def write(self, message: HistoryWrite, idempotency_key: str | None) -> None:
+        # Workers of every process write one chat in turn, not interleaved
+        lock = self.make_lock(message.chat_id)
+        if not await lock.acquire():
+            raise LockError(f"History of chat {message.chat_id} is locked")
+        try:
+            async with self.redis.renewing(lock):
+                if await self.is_fenced(message.chat_id, idempotency_key):
+                    raise HistoryWriteFenced()
+                if isinstance(message, AddUserMessage):
+                    await add_user_message_request(
+                        session=self.session,
+                        pydantic_model=message,
+                        idempotency_key=idempotency_key,
+                    )
+                elif isinstance(message, AddAIMessage):
+                    await add_ai_message_request(
+                        session=self.session,
+                        pydantic_model=message,
+                        idempotency_key=idempotency_key,
+                    )
+                else:
+                    await add_exchange_request(
+                        session=self.session,
+                        pydantic_model=message,
+                        idempotency_key=idempotency_key,
+                    )
+        finally:
+            await self.release_lock(lock)
+
+    async def work(self, queue: asyncio.Queue) -> None:
+        while True:
+            entry_id, message = await queue.get()
+            metrics.set_gauge("messaging.history_writer.queue_depth", self.queue_depth)
+            try:
+                held = self.held.get(message.chat_id)
+                if held is not None:
+                    # An earlier write of the chat is still failing, this one waits
+                    held.append((entry_id, message))
+                    continue
+                try:
+                    await self.write_with_retries(message, idempotency_key=entry_id)
+                except Exception as generic_error:
+                    if not self.rejected(generic_error):
+                        self.hold(entry_id, message, generic_error)
+                        continue
+                    await self.fail(entry_id, message, generic_error)
+                else:
+                    metrics.increment("messaging.history_writer.written")
+                    await self.forget(entry_id)
+                await self.finish(entry_id, message)
+            finally:
+                queue.task_done()
+
+    @staticmethod
+    def rejected(error: Exception) -> bool:
+        return isinstance(error, HTTPException) and error.status_code < 500
+
+    def hold(
+        self, entry_id: str | None, message: HistoryWrite, error: Exception
+    ) -> None:
+        # Later writes of the chat are held back until this one is written, so the
+        # history service never receives them out of order
+        metrics.increment("messaging.history_writer.held")
+        logging.error(f"History write for chat {message.chat_id} is held: {error}")
+        self.held[message.chat_id] = deque([(entry_id, message)])
+        release = asyncio.create_task(self.release_held(message.chat_id))
+        self.releases.add(release)
+        release.add_done_callback(self.releases.discard)
+
+    async def release_held(self, chat_id: uuid.UUID) -> None:
+        held = self.held[chat_id]
+        delay = self.retry_delay
+        while held:
+            entry_id, message = held[0]
+            try:
+                await self.write_with_retries(message, idempotency_key=entry_id)
+            except Exception as generic_error:
+                if not self.rejected(generic_error):
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.sweep_interval)
+                    continue
+                await self.fail(entry_id, message, generic_error)
+            else:
+                metrics.increment("messaging.history_writer.written")
+                await self.forget(entry_id)
+            delay = self.retry_delay
+            held.popleft()
+            await self.finish(entry_id, message)
+        del self.held[chat_id]
+
+    async def fail(
+        self, entry_id: str | None, message: HistoryWrite, error: Exception
+    ) -> None:
+        # Rejected writes will never succeed, so they leave the journal
+        if isinstance(error, HistoryWriteFenced):
+            metrics.increment("messaging.history_writer.fenced")
+        else:
+            metrics.increment("messaging.history_writer.failed")
+            logging.error(f"History write for chat {message.chat_id} failed: {error}")
+        await self.forget(entry_id)
+        # The cached history already contains the messages that were not written
+        await self.invalidate(chat_id=message.chat_id)
+
+    @staticmethod
+    async def begin(chat_id: uuid.UUID) -> None:
+        try:
+            await messaging_cache_manager.begin_history_write(chat_id=chat_id)
+        except Exception as generic_error:
+            logging.error(f"History writer cache error: {generic_error}")
+
+    async def finish(self, entry_id: str | None, message: HistoryWrite) -> None:
+        try:
+            await messaging_cache_manager.end_history_write(chat_id=message.chat_id)
+        except Exception as generic_error:
+            logging.error(f"History writer cache error: {generic_error}")
+        self.queued.discard(entry_id)
+        self.pending[message.chat_id] -= 1
+        if self.pending[message.chat_id] <= 0:
+            del self.pending[message.chat_id]
+        async with self.written:
+            self.written.notify_all()
+
+    @staticmethod
+    async def invalidate(chat_id: uuid.UUID) -> None:
+        try:
+            await messaging_cache_manager.delete_chat(chat_id=chat_id)
+        except Exception as generic_error:
+            logging.error(f"History writer cache error: {generic_error}")
+
+    async def forget(self, entry_id: str | None) -> None:
+        # A replay of an entry left behind here is dropped upstream by its key
+        if entry_id is None:
+            return
+        try:
+            await self.redis.stream_delete(self.stream, entry_id)
+        except Exception as generic_error:
+            logging.error(f"History journal error: {generic_error}")
+
+    async def write_with_retries(
+        self, message: HistoryWrite, idempotency_key: str | None
+    ) -> None:
+        # The journal entry id lets the history service drop a write it already has
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self.write(message, idempotency_key=idempotency_key)
+            except HistoryWriteFenced:
+                raise
+            except ExchangeUnsupported:
+                # Nothing is written yet, retrying the halves separately means a
+                # failed answer never duplicates its question
+                await self.write_with_retries(
+                    AddUserMessage(
+                        chat_id=message.chat_id, message=message.user_message
+                    ),
+                    idempotency_key=idempotency_key and f"{idempotency_key}:user",
+                )
+                await self.write_with_retries(
+                    AddAIMessage(chat_id=message.chat_id, message=message.ai_message),
+                    idempotency_key=idempotency_key and f"{idempotency_key}:ai",
+                )
+                return
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                metrics.increment("messaging.history_writer.retries")
+                await asyncio.sleep(self.retry_delay * 2**attempt)
+
+    async def recover(self) -> None:
+        while True:
+            await self.sweep()
+            await asyncio.sleep(self.sweep_interval)
+
+    async def sweep(self) -> None:
+        # Replays journaled writes left behind by workers that died before flushing
+        # them, one process per interval
+        try:
+            if not await self.redis.set_if_absent(
+                self.recovery_lease, "1", ttl=self.sweep_interval
+            ):
+                return
+            max_id = str(int(time.time() * 1000) - self.recovery_age * 1000)
+            entries = [
+                (entry_id, fields)
+                for entry_id, fields in await self.redis.stream_range(
+                    self.stream, max=max_id
+                )
+                if entry_id not in self.queued
+            ]
+            for entry_id, fields in entries:
+                model = HISTORY_WRITE_MODELS[fields["kind"]]
+                message = model.model_validate_json(fields["payload"])
+                await self.begin(chat_id=message.chat_id)
+                self.put(entry_id, message)
+            if entries:
+                metrics.increment("messaging.history_writer.recovered", len(entries))
+                logging.info(f"Recovered {len(entries)} journaled history writes")
+        except Exception as generic_error:
+            logging.error(f"History writer recovery error: {generic_error}")
+
+    async def drain(self) -> None:
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(queue.join() for queue in self.queues)),
+                timeout=self.drain_timeout,
+            )
+        except asyncio.TimeoutError:
+            logging.error(
+                f"History writer drain timed out, {self.queue_depth} writes left in the journal"
+            )
+        if self.held:
+            logging.error(
+                f"History writes of {len(self.held)} chats are held, they stay in the journal"
+            )
+        tasks = [*self.workers, *self.releases]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.workers = []
+
+
+history_writer = HistoryWriter(
+    RedisRepository,
+    partitions=settings.history_writer_settings.history_writer_partitions,
+    max_retries=settings.history_writer_settings.history_writer_max_retries,
+    retry_delay=settings.history_writer_settings.history_writer_retry_delay,
+    drain_timeout=settings.history_writer_settings.history_writer_drain_timeout,
+    recovery_age=settings.history_writer_settings.history_writer_recovery_age,
+    sweep_interval=settings.history_writer_settings.history_writer_sweep_interval,
+    lock_timeout=settings.history_writer_settings.history_writer_lock_timeout,
+    fence_ttl=settings.history_writer_settings.history_writer_fence_ttl,
+)
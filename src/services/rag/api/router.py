@@ -1,9 +1,48 @@
-from typing import Annotated
-from ..schemas.qa import GenerationCredentials, ModelAnswer
+import logging
+from typing import Annotated, Awaitable
+from ..schemas.qa import (
+    GenerationCredentials,
+    ModelAnswer,
+    MultiVaultGenerationCredentials,
+    MultiVaultModelAnswer,
+    BatchQuestions,
+    BatchJobStatus,
+)
+from ..utils.cache import batch_job_store
 import aiohttp
-from fastapi import APIRouter, Depends
-from src.dependencies import parse_jwt_bearer, get_aiohttp_session
-from ..service import generate_answer
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    Response,
+    WebSocket,
+    status,
+)
+from fastapi.responses import StreamingResponse
+from pydantic import UUID4
+from src.dependencies import (
+    parse_jwt_bearer,
+    limit_generation,
+    limit_reads,
+    parse_jwt_token,
+    get_aiohttp_session,
+    get_websocket_aiohttp_session,
+)
+from ..service import (
+    generate_answer,
+    generate_multi_vault_answer,
+    stream_answer,
+    ChatChannel,
+    cancel_on_disconnect,
+    batch_runner,
+)
+from src.idempotency import idempotency_store
+from src.rate_limit import rate_limiter
+from src.schemas import JWTPayload
 from src.services.vaults.service.vaults import VaultsService
 from src.services.vaults.api.dependencies import get_vaults_service
 from src.services.messaging.service.messaging import MessagingService
@@ -14,21 +53,197 @@ router = APIRouter(prefix="/qa", tags=["QA"])
 
 @router.post(
     "/generation",
+    dependencies=[Depends(limit_generation)],
     response_model=ModelAnswer,
-    dependencies=[Depends(parse_jwt_bearer)],
-    description="Генерация ответа LLM",
+    description="Генерация ответа LLM. С заголовком Idempotency-Key повторный запрос дожидается исходного и возвращает его ответ (заголовок Idempotent-Replayed: true), а генерация не отменяется при разрыве соединения",
 )
 async def answer_generation(
+    request: Request,
+    response: Response,
+    jwt_payload: Annotated[JWTPayload, Depends(parse_jwt_bearer)],
     generation_credentials: GenerationCredentials,
     vaults_service: Annotated[VaultsService, Depends(get_vaults_service)],
     messaging_service: Annotated[MessagingService, Depends(get_messaging_service)],
     session: Annotated[aiohttp.ClientSession, Depends(get_aiohttp_session)],
+    idempotency_key: Annotated[str | None, Header(max_length=255)] = None,
 ) -> ModelAnswer:
-    ai_message = await generate_answer(
+    def generate() -> Awaitable[ModelAnswer]:
+        return generate_answer(
+            user_id=jwt_payload.user_id,
+            generation_credentials=generation_credentials,
+            messaging_service=messaging_service,
+            vaults_service=vaults_service,
+            session=session,
+        )
+
+    if idempotency_key is None:
+        return await cancel_on_disconnect(request, generate())
+
+    # A client that sends the key retries on timeouts, so the original keeps
+    # running after a disconnect for the retry to pick up
+    ai_message, replayed = await idempotency_store.execute(
+        scope="generation",
+        user_id=jwt_payload.user_id,
+        idempotency_key=idempotency_key,
+        fingerprint=generation_credentials.model_dump_json(),
+        model=ModelAnswer,
+        call=generate,
+    )
+    if replayed:
+        response.headers["idempotent-replayed"] = "true"
+    return ai_message
+
+
+@router.post(
+    "/generation/multi",
+    dependencies=[Depends(limit_generation)],
+    response_model=MultiVaultModelAnswer,
+    description="Генерация ответа LLM по нескольким хранилищам. Хранилища, не ответившие до дедлайна, возвращаются с timed_out=True",
+)
+async def multi_vault_answer_generation(
+    request: Request,
+    jwt_payload: Annotated[JWTPayload, Depends(parse_jwt_bearer)],
+    generation_credentials: MultiVaultGenerationCredentials,
+    vaults_service: Annotated[VaultsService, Depends(get_vaults_service)],
+    messaging_service: Annotated[MessagingService, Depends(get_messaging_service)],
+    session: Annotated[aiohttp.ClientSession, Depends(get_aiohttp_session)],
+) -> MultiVaultModelAnswer:
+    ai_message = await cancel_on_disconnect(
+        request,
+        generate_multi_vault_answer(
+            user_id=jwt_payload.user_id,
+            generation_credentials=generation_credentials,
+            messaging_service=messaging_service,
+            vaults_service=vaults_service,
+            session=session,
+        ),
+    )
+
+    return ai_message
+
+
+@router.post(
+    "/generation/stream",
+    response_class=StreamingResponse,
+    description="Генерация ответа LLM в режиме потока (Server-Sent Events). События `chunk` содержат части ответа, событие `end` - traceback и ошибки, событие `error` - ошибку RAG сервиса",
+)
+async def answer_generation_stream(
+    jwt_payload: Annotated[JWTPayload, Depends(parse_jwt_bearer)],
+    rate_limit_headers: Annotated[dict[str, str], Depends(limit_generation)],
+    generation_credentials: GenerationCredentials,
+    vaults_service: Annotated[VaultsService, Depends(get_vaults_service)],
+    messaging_service: Annotated[MessagingService, Depends(get_messaging_service)],
+    session: Annotated[aiohttp.ClientSession, Depends(get_aiohttp_session)],
+) -> StreamingResponse:
+    events = stream_answer(
+        user_id=jwt_payload.user_id,
         generation_credentials=generation_credentials,
         messaging_service=messaging_service,
         vaults_service=vaults_service,
         session=session,
     )
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={
+            "cache-control": "no-cache",
+            "x-accel-buffering": "no",
+            **rate_limit_headers,
+        },
+    )
 
-    return ai_message
+
+@router.post(
+    "/batch",
+    response_class=StreamingResponse,
+    description="Пакетная генерация ответов по хранилищу без истории чата. Результаты возвращаются в формате NDJSON: первая и последняя строки - статус задачи, остальные - ответы на вопросы. Задача продолжает выполняться после разрыва соединения, результаты доступны по GET /qa/batch/{job_id}",
+)
+async def batch_answer_generation(
+    jwt_payload: Annotated[JWTPayload, Depends(parse_jwt_bearer)],
+    batch_questions: BatchQuestions,
+    vaults_service: Annotated[VaultsService, Depends(get_vaults_service)],
+    session: Annotated[aiohttp.ClientSession, Depends(get_aiohttp_session)],
+) -> StreamingResponse:
+    # Every question of the batch is a generation of its own
+    decision = await rate_limiter.check(
+        route_class="generation",
+        user_id=jwt_payload.user_id,
+        cost=len(batch_questions.questions),
+    )
+    rate_limit_headers = dict() if decision is None else decision.headers
+    job = await batch_runner.start(
+        user_id=jwt_payload.user_id,
+        batch_questions=batch_questions,
+        vaults_service=vaults_service,
+        session=session,
+    )
+    return StreamingResponse(
+        job.stream(),
+        media_type="application/x-ndjson",
+        headers={
+            "x-job-id": str(job.status.job_id),
+            "x-accel-buffering": "no",
+            **rate_limit_headers,
+        },
+    )
+
+
+@router.get(
+    "/batch/{job_id}",
+    dependencies=[Depends(limit_reads)],
+    response_model=BatchJobStatus,
+    description="Статус и результаты пакетной задачи",
+)
+async def get_batch_job(
+    jwt_payload: Annotated[JWTPayload, Depends(parse_jwt_bearer)],
+    job_id: Annotated[UUID4, Path()],
+) -> BatchJobStatus:
+    user_id, job_status = await batch_job_store.get_job(job_id=job_id)
+    if job_status is None or user_id != jwt_payload.user_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Batch job not found"
+        )
+    return job_status
+
+
+@router.websocket("/ws/{chat_id}")
+async def chat_channel(
+    websocket: WebSocket,
+    chat_id: Annotated[UUID4, Path()],
+    vaults_service: Annotated[VaultsService, Depends(get_vaults_service)],
+    messaging_service: Annotated[MessagingService, Depends(get_messaging_service)],
+    session: Annotated[aiohttp.ClientSession, Depends(get_websocket_aiohttp_session)],
+    token: Annotated[str | None, Query()] = None,
+) -> None:
+    await websocket.accept()
+    try:
+        jwt_payload = await parse_jwt_token(token=token)
+    except HTTPException as http_exception:
+        await websocket.close(
+            code=status.WS_1008_POLICY_VIOLATION, reason=http_exception.detail
+        )
+        return
+
+    channel = ChatChannel(
+        websocket=websocket,
+        chat_id=chat_id,
+        user_id=jwt_payload.user_id,
+        messaging_service=messaging_service,
+        vaults_service=vaults_service,
+        session=session,
+    )
+    try:
+        await channel.open()
+    except HTTPException as http_exception:
+        await websocket.close(
+            code=status.WS_1011_INTERNAL_ERROR, reason=str(http_exception.detail)
+        )
+        return
+    except Exception as generic_error:
+        logging.error(f"Chat channel open error: {generic_error}")
+        await websocket.close(
+            code=status.WS_1011_INTERNAL_ERROR, reason="Chat channel could not open"
+        )
+        return
+
+    await channel.run()
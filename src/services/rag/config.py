@@ -1,3 +1,5 @@
+import uuid
+from typing import Literal
 from pydantic import HttpUrl, BaseModel
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pathlib import Path
@@ -9,25 +11,118 @@ class GraphRagServiceSettings(BaseSettings):
     model_config = SettingsConfigDict(env_file=RAG_SERVICE_DIR / ".env", extra="ignore")
     graph_rag_service_host: str
     graph_rag_service_port: int
+    # Replicas as "host:port", the single host and port are used when it is empty
+    graph_rag_service_instances: list[str] = []
 
     @property
     def graph_rag_service_url(self) -> HttpUrl:
         return f"http://{self.graph_rag_service_host}:{self.graph_rag_service_port}"
 
+    @property
+    def graph_rag_service_urls(self) -> list[HttpUrl]:
+        if not self.graph_rag_service_instances:
+            return [self.graph_rag_service_url]
+        return [f"http://{instance}" for instance in self.graph_rag_service_instances]
+
 
 class VectorRagServiceSettings(BaseSettings):
     model_config = SettingsConfigDict(env_file=RAG_SERVICE_DIR / ".env", extra="ignore")
     vector_rag_service_host: str
     vector_rag_service_port: int
+    vector_rag_service_instances: list[str] = []
 
     @property
     def vector_rag_service_url(self) -> HttpUrl:
         return f"http://{self.vector_rag_service_host}:{self.vector_rag_service_port}"
 
+    @property
+    def vector_rag_service_urls(self) -> list[HttpUrl]:
+        if not self.vector_rag_service_instances:
+            return [self.vector_rag_service_url]
+        return [f"http://{instance}" for instance in self.vector_rag_service_instances]
+
+
+class BalancerSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=RAG_SERVICE_DIR / ".env", extra="ignore")
+    balancer_strategy: Literal["least_outstanding", "power_of_two"] = (
+        "least_outstanding"
+    )
+    balancer_failure_threshold: int = 3
+    balancer_ejection_time: float = 30
+    balancer_latency_decay: float = 0.2
+
+
+class TokenCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=RAG_SERVICE_DIR / ".env", extra="ignore")
+    token_cache_max_entries: int = 100_000
+    token_cache_ttl: int = 60 * 60 * 24 * 7
+    history_token_index_ttl: int = 60 * 60 * 24
+
+
+class AnswerCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=RAG_SERVICE_DIR / ".env", extra="ignore")
+    answer_cache_enabled: bool = True
+    answer_cache_ttl: int = 60 * 60
+
+
+class SchedulerSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=RAG_SERVICE_DIR / ".env", extra="ignore")
+    scheduler_graph_concurrency: int = 8
+    scheduler_vector_concurrency: int = 16
+    scheduler_max_queue: int = 256
+    scheduler_max_user_queue: int = 4
+    scheduler_max_wait: float = 30
+    scheduler_user_weights: dict[uuid.UUID, float] = dict()
+
+
+class CancellationSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=RAG_SERVICE_DIR / ".env", extra="ignore")
+    # discard: keep nothing, question: keep the question only,
+    # partial: also keep the part of the answer streamed before the disconnect
+    cancelled_exchange_policy: Literal["discard", "question", "partial"] = "question"
+    disconnect_poll_interval: float = 0.5
+
+
+class FanoutSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=RAG_SERVICE_DIR / ".env", extra="ignore")
+    fanout_concurrency: int = 4
+    fanout_deadline: float = 120
+
+
+class BatchSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=RAG_SERVICE_DIR / ".env", extra="ignore")
+    batch_concurrency: int = 4
+    batch_max_retries: int = 3
+    batch_result_ttl: int = 60 * 60 * 24
+
+
+class ChatLockSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=RAG_SERVICE_DIR / ".env", extra="ignore")
+    # The holder renews the lease every third of it, so only a dead worker's lock
+    # lapses, at most this long after it died
+    chat_lock_timeout: float = 30
+    chat_lock_wait: float = 60 * 5
+    chat_lock_settle_timeout: float = 10
+
+
+class TokenizerSettings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=RAG_SERVICE_DIR / ".env", extra="ignore")
+    tokenizer_executor: Literal["thread", "process"] = "thread"
+    tokenizer_workers: int = 2
+
 
 class Setting(BaseModel):
     vector_rag_service: VectorRagServiceSettings = VectorRagServiceSettings()
     graph_rag_service: GraphRagServiceSettings = GraphRagServiceSettings()
+    token_cache: TokenCacheSettings = TokenCacheSettings()
+    tokenizer: TokenizerSettings = TokenizerSettings()
+    answer_cache: AnswerCacheSettings = AnswerCacheSettings()
+    scheduler: SchedulerSettings = SchedulerSettings()
+    balancer: BalancerSettings = BalancerSettings()
+    cancellation: CancellationSettings = CancellationSettings()
+    fanout: FanoutSettings = FanoutSettings()
+    batch: BatchSettings = BatchSettings()
+    chat_lock: ChatLockSettings = ChatLockSettings()
 
 
 settings = Setting()
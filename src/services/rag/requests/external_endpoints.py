@@ -3,10 +3,13 @@ from ..config import settings
 
 
 class RagEndpoints(BaseModel):
-    graph_answer: str = f"{settings.graph_rag_service.graph_rag_service_url}/answer"
-    vector_answer: str = (
-        f"{settings.vector_rag_service.vector_rag_service_url}/qa/answer"
-    )
+    graph_answer: list[str] = [
+        f"{url}/answer" for url in settings.graph_rag_service.graph_rag_service_urls
+    ]
+    vector_answer: list[str] = [
+        f"{url}/qa/answer"
+        for url in settings.vector_rag_service.vector_rag_service_urls
+    ]
 
 
 rag_endpoints: RagEndpoints = RagEndpoints()
@@ -1 +1,2 @@
 from .get import get_answer_request
+from .stream import stream_answer_request
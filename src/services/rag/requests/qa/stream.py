@@ -0,0 +1,34 @@
+import json
+from typing import AsyncIterator
+import aiohttp
+from fastapi import HTTPException
+from src.utils import aiohttp_stream_error_handler
+from ...schemas.qa import AnswerGenerationCredentials
+
+
+@aiohttp_stream_error_handler(service_name="RAG")
+async def stream_answer_request(
+    session: aiohttp.ClientSession,
+    pydantic_model: AnswerGenerationCredentials,
+    endpoint: str,
+) -> AsyncIterator[dict]:
+    headers = {"accept": "text/event-stream, application/json"}
+    json_data = pydantic_model.model_dump(mode="json")
+
+    timeout = aiohttp.ClientTimeout(total=60 * 5)
+    async with session.post(
+        url=endpoint, headers=headers, json=json_data, timeout=timeout
+    ) as response:
+        if response.status >= 400:
+            result = await response.json()
+            raise HTTPException(status_code=response.status, detail=result["detail"])
+
+        # Backends without streaming support answer with the whole AIMessage at once
+        if response.content_type != "text/event-stream":
+            yield await response.json()
+            return
+
+        async for line in response.content:
+            line = line.decode().strip()
+            if line.startswith("data:"):
+                yield json.loads(line.removeprefix("data:"))
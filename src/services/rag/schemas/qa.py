@@ -1,7 +1,9 @@
+from typing import Literal
 from pydantic import BaseModel, UUID4, Field
 from src.services.messaging.schemas.history import (
     UserMessageResponse,
     AIMessageResponse,
+    TracebackUnit,
 )
 
 
@@ -11,14 +13,30 @@ class GenerationCredentials(BaseModel):
     query: str
 
 
+class MultiVaultGenerationCredentials(BaseModel):
+    vault_ids: list[UUID4] = Field(min_length=1, max_length=16)
+    chat_id: UUID4
+    query: str
+
+
+class ChatQuestion(BaseModel):
+    query: str
+
+
 class AnswerGenerationCredentials(BaseModel):
     vault_id: UUID4 | None
     query: str
     history: list[UserMessageResponse | AIMessageResponse] | None
 
 
-class ModelAnswer(BaseModel):
-    ai_message: AIMessageResponse
+class GenerationContext(BaseModel):
+    answer_generation_credentials: AnswerGenerationCredentials
+    backend: Literal["graph", "vector"]
+    history_error: str | None = None
+    vault_error: str | None = None
+
+
+class GenerationExceptions(BaseModel):
     history_exception: dict[bool, str] = Field(examples=[{False: ""}])
     vault_exception: dict[bool, str] = Field(
         examples=[{True: "500: service: an unexpected error occurred."}]
@@ -29,3 +47,52 @@ class ModelAnswer(BaseModel):
     add_ai_message_exception: dict[bool, str] = Field(
         examples=[{True: "500: service: an unexpected error occurred."}]
     )
+
+
+class QueueReport(BaseModel):
+    queue_position: int = Field(default=0, examples=[3])
+    queue_wait: float = Field(default=0.0, examples=[1.25])
+
+
+class ModelAnswer(GenerationExceptions, QueueReport):
+    ai_message: AIMessageResponse
+
+
+class StreamedAnswerEnd(GenerationExceptions, QueueReport):
+    traceback: list[TracebackUnit | None]
+
+
+class VaultAnswer(BaseModel):
+    vault_id: UUID4
+    ai_message: AIMessageResponse | None
+    exception: dict[bool, str] = Field(examples=[{False: ""}])
+    timed_out: bool = False
+
+
+class MultiVaultModelAnswer(BaseModel):
+    ai_message: AIMessageResponse
+    vault_answers: list[VaultAnswer]
+    history_exception: dict[bool, str] = Field(examples=[{False: ""}])
+    add_user_message_exception: dict[bool, str] = Field(examples=[{False: ""}])
+    add_ai_message_exception: dict[bool, str] = Field(examples=[{False: ""}])
+
+
+class BatchQuestions(BaseModel):
+    vault_id: UUID4
+    questions: list[str] = Field(min_length=1, max_length=1000)
+
+
+class BatchResult(BaseModel):
+    index: int
+    query: str
+    ai_message: AIMessageResponse | None
+    exception: dict[bool, str] = Field(examples=[{False: ""}])
+
+
+class BatchJobStatus(BaseModel):
+    job_id: UUID4
+    vault_id: UUID4
+    status: Literal["running", "done", "cancelled", "failed"]
+    total: int
+    completed: int = 0
+    results: list[BatchResult] = []
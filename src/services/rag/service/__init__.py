@@ -1 +1,5 @@
-from .generate_answer import generate_answer
+from .generate_answer import generate_answer, cancel_on_disconnect
+from .stream_answer import stream_answer
+from .chat_channel import ChatChannel
+from .multi_vault_answer import generate_multi_vault_answer
+from .batch_answer import batch_runner
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import uuid
+from typing import AsyncIterator
+import aiohttp
+from ..config import settings
+from ..schemas.qa import (
+    AnswerGenerationCredentials,
+    BatchJobStatus,
+    BatchQuestions,
+    BatchResult,
+)
+from ..utils.cache import batch_job_store
+from ..utils.scheduler import SchedulerRejection
+from src.metrics import metrics
+from src.services.messaging.schemas.history import AIMessageResponse
+from src.services.vaults.schemas.vault import VaultCredentials, VaultType
+from ...vaults.service.vaults import VaultsService
+from .generate_answer import request_answer, make_exception
+
+
+class BatchJob:
+    def __init__(self, user_id: uuid.UUID, batch_questions: BatchQuestions):
+        self.user_id = user_id
+        self.questions = batch_questions.questions
+        self.status = BatchJobStatus(
+            job_id=uuid.uuid4(),
+            vault_id=batch_questions.vault_id,
+            status="running",
+            total=len(batch_questions.questions),
+        )
+        self.results: asyncio.Queue[BatchResult | None] = asyncio.Queue()
+
+    async def stream(self) -> AsyncIterator[str]:
+        yield self.status.model_dump_json(exclude={"results"}) + "\n"
+        while (result := await self.results.get()) is not None:
+            yield result.model_dump_json() + "\n"
+        yield self.status.model_dump_json(exclude={"results"}) + "\n"
+
+
+class BatchRunner:
+    # Questions of a batch skip chat history. All batches of a user share one
+    # fair-share identity of their own, so they neither crowd out chats of other
+    # users nor fill the queue their owner's interactive questions need
+    def __init__(self, concurrency: int, max_retries: int):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.tasks: set[asyncio.Task] = set()
+
+    async def start(
+        self,
+        user_id: uuid.UUID,
+        batch_questions: BatchQuestions,
+        vaults_service: VaultsService,
+        session: aiohttp.ClientSession,
+    ) -> BatchJob:
+        job = BatchJob(user_id=user_id, batch_questions=batch_questions)
+        await batch_job_store.create_job(user_id=user_id, job_status=job.status)
+
+        task = asyncio.create_task(
+            self.run(job=job, vaults_service=vaults_service, session=session)
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return job
+
+    async def run(
+        self,
+        job: BatchJob,
+        vaults_service: VaultsService,
+        session: aiohttp.ClientSession,
+    ) -> None:
+        metrics.increment("rag.batch.jobs")
+        try:
+            vault_error = None
+            try:
+                vault_type = await vaults_service.get_vault_type(
+                    session=session,
+                    vault_credentials=VaultCredentials(vault_id=job.status.vault_id),
+                )
+            except Exception as generic_error:
+                vault_type = None
+                vault_error = str(generic_error)
+
+            questions = asyncio.Queue()
+            for index, query in enumerate(job.questions):
+                questions.put_nowait((index, query))
+
+            async def work() -> None:
+                while not questions.empty():
+                    index, query = questions.get_nowait()
+                    if vault_type is None:
+                        result = BatchResult(
+                            index=index,
+                            query=query,
+                            ai_message=None,
+                            exception=make_exception(vault_error),
+                        )
+                    else:
+                        result = await self.answer(
+                            job=job,
+                            backend=(
+                                "vector" if vault_type == VaultType.VECTOR else "graph"
+                            ),
+                            index=index,
+                            query=query,
+                            session=session,
+                        )
+                    await self.publish(job, result)
+
+            await asyncio.gather(
+                *(work() for _ in range(min(self.concurrency, len(job.questions))))
+            )
+            job.status.status = "done"
+        except asyncio.CancelledError:
+            # Stopped at shutdown, the questions left are never answered
+            job.status.status = "cancelled"
+            raise
+        except Exception:
+            job.status.status = "failed"
+            raise
+        finally:
+            job.results.put_nowait(None)
+            try:
+                await batch_job_store.set_job(
+                    user_id=job.user_id, job_status=job.status
+                )
+            except Exception as generic_error:
+                logging.error(f"Batch job store error: {generic_error}")
+
+    async def answer(
+        self,
+        job: BatchJob,
+        backend: str,
+        index: int,
+        query: str,
+        session: aiohttp.ClientSession,
+    ) -> BatchResult:
+        credentials = AnswerGenerationCredentials(
+            vault_id=job.status.vault_id, query=query, history=[]
+        )
+        for attempt in range(self.max_retries + 1):
+            try:
+                answer, _ = await request_answer(
+                    user_id=self.make_scheduler_id(job.user_id),
+                    backend=backend,
+                    credentials=credentials,
+                    session=session,
+                    background=True,
+                )
+            except SchedulerRejection as rejection:
+                if attempt == self.max_retries:
+                    error = str(rejection)
+                    break
+                await asyncio.sleep(int(rejection.headers["Retry-After"]))
+            except Exception as generic_error:
+                error = str(generic_error)
+                break
+            else:
+                return BatchResult(
+                    index=index,
+                    query=query,
+                    ai_message=AIMessageResponse(**answer.model_dump(), role="ai"),
+                    exception=make_exception(None),
+                )
+
+        metrics.increment("rag.batch.failed_questions")
+        return BatchResult(
+            index=index, query=query, ai_message=None, exception=make_exception(error)
+        )
+
+    @staticmethod
+    def make_scheduler_id(user_id: uuid.UUID) -> uuid.UUID:
+        return uuid.uuid5(user_id, "batch")
+
+    async def publish(self, job: BatchJob, result: BatchResult) -> None:
+        job.status.completed += 1
+        job.results.put_nowait(result)
+        metrics.increment("rag.batch.questions")
+        try:
+            await batch_job_store.add_result(job_id=job.status.job_id, result=result)
+        except Exception as generic_error:
+            logging.error(f"Batch job store error: {generic_error}")
+
+    async def shutdown(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+batch_runner = BatchRunner(
+    concurrency=settings.batch.batch_concurrency,
+    max_retries=settings.batch.batch_max_retries,
+)
@@ -0,0 +1,260 @@
+import logging
+import time
+import uuid
+import aiohttp
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect, status
+from pydantic import ValidationError
+from ..requests.qa import stream_answer_request
+from ..schemas.qa import AnswerGenerationCredentials, ChatQuestion
+from ..utils.scheduler import schedulers
+from ..utils.balancer import rag_balancers
+from ..utils.chat_lock import chat_lock
+from ..utils.history import (
+    count_tokens,
+    get_history_prefix_sums,
+    truncate_by_prefix_sums,
+)
+from src.rate_limit import rate_limiter
+from src.services.messaging.schemas.chat import ChatCredentials
+from src.services.messaging.schemas.history import (
+    AIMessage,
+    AIMessageResponse,
+    UserMessageResponse,
+)
+from src.services.messaging.service.messaging import MessagingService
+from src.services.messaging.utils.cache import messaging_cache_manager
+from src.services.vaults.schemas.vault import VaultCredentials, VaultType
+from ...vaults.service.vaults import VaultsService
+from .generate_answer import (
+    add_user_message,
+    add_exchange,
+    make_exception,
+    get_cached_answer,
+    cache_answer,
+)
+
+
+class ChatChannel:
+    def __init__(
+        self,
+        websocket: WebSocket,
+        chat_id: uuid.UUID,
+        user_id: uuid.UUID,
+        messaging_service: MessagingService,
+        vaults_service: VaultsService,
+        session: aiohttp.ClientSession,
+    ):
+        self.websocket = websocket
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.messaging_service = messaging_service
+        self.vaults_service = vaults_service
+        self.session = session
+        self.vault_id: uuid.UUID | None = None
+        self.backend = "graph"
+        self.history: list[UserMessageResponse | AIMessageResponse] = []
+        self.prefix_sums: list[int] = [0]
+
+    async def open(self) -> None:
+        chat_payload = await self.messaging_service.get_chat_by_user_id(
+            session=self.session,
+            chat_credentials=ChatCredentials(chat_id=self.chat_id),
+        )
+        if chat_payload.chat_history is not None:
+            self.history = list(chat_payload.chat_history.history)
+        self.prefix_sums = await get_history_prefix_sums(
+            self.history, chat_id=self.chat_id
+        )
+
+        vault_error = None
+        try:
+            vault_type = await self.vaults_service.get_vault_type(
+                session=self.session,
+                vault_credentials=VaultCredentials(vault_id=chat_payload.vault_id),
+            )
+        except Exception as generic_error:
+            vault_error = str(generic_error)
+        else:
+            self.vault_id = chat_payload.vault_id
+            if vault_type == VaultType.VECTOR:
+                self.backend = "vector"
+
+        await self.websocket.send_json(
+            {"event": "ready", "vault_exception": make_exception(vault_error)}
+        )
+
+    async def run(self) -> None:
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                # Malformed frames are answered with an error, the channel stays open
+                data = message.get("text") or message.get("bytes") or ""
+                try:
+                    question = ChatQuestion.model_validate_json(data)
+                except ValidationError as validation_error:
+                    await self.websocket.send_json(
+                        {
+                            "event": "error",
+                            "status_code": status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            "detail": validation_error.errors(
+                                include_url=False, include_input=False
+                            ),
+                        }
+                    )
+                    continue
+                await self.answer(query=question.query)
+        except WebSocketDisconnect:
+            pass
+
+    async def answer(self, query: str) -> None:
+        try:
+            # Every question costs a generation, like a POST /qa/generation would
+            await rate_limiter.check(route_class="generation", user_id=self.user_id)
+            async with chat_lock.hold(chat_id=self.chat_id):
+                await self.refresh()
+                await self.generate(query=query)
+        except HTTPException as http_exception:
+            await self.send_error(http_exception)
+
+    async def refresh(self) -> None:
+        # Other requests may have added exchanges to the chat since the last question.
+        # The cached history length tells without reading it, a missing cache means
+        # it was cleaned or has expired
+        try:
+            cached_length = await messaging_cache_manager.get_history_length(
+                chat_id=self.chat_id
+            )
+        except Exception as generic_error:
+            logging.error(f"Chat channel history length error: {generic_error}")
+            cached_length = None
+        if cached_length == len(self.history):
+            return
+
+        try:
+            chat_history = await self.messaging_service.get_chat_history(
+                session=self.session,
+                chat_credentials=ChatCredentials(chat_id=self.chat_id),
+            )
+        except Exception as generic_error:
+            logging.error(f"Chat channel history refresh error: {generic_error}")
+            return
+        if len(chat_history.history) != len(self.history):
+            self.history = list(chat_history.history)
+            self.prefix_sums = await get_history_prefix_sums(
+                self.history, chat_id=self.chat_id
+            )
+
+    async def generate(self, query: str) -> None:
+        answer_generation_credentials = AnswerGenerationCredentials(
+            vault_id=self.vault_id,
+            query=query,
+            history=truncate_by_prefix_sums(
+                self.history, self.prefix_sums, max_tokens=3000
+            ),
+        )
+
+        answer, generation = await get_cached_answer(answer_generation_credentials)
+        if answer is not None:
+            await self.websocket.send_json(
+                {"event": "chunk", "content": answer.content}
+            )
+        else:
+            try:
+                async with schedulers[self.backend].slot(
+                    user_id=self.user_id
+                ) as ticket:
+                    await self.websocket.send_json(
+                        {
+                            "event": "queue",
+                            "queue_position": ticket.position,
+                            "queue_wait": ticket.wait,
+                        }
+                    )
+                    answer = await self.stream(
+                        answer_generation_credentials, generation=generation
+                    )
+            except HTTPException as http_exception:
+                # Rejected by the scheduler, the question never reached the model
+                await self.send_error(http_exception)
+                return
+            if answer is None:
+                await self.remember(query=query, answer=None)
+                return
+
+        await self.websocket.send_json(
+            {"event": "end", **answer.model_dump(mode="json", include={"traceback"})}
+        )
+        await self.remember(query=query, answer=answer)
+
+    async def stream(
+        self,
+        answer_generation_credentials: AnswerGenerationCredentials,
+        generation: str | None,
+    ) -> AIMessage | None:
+        started_at = time.perf_counter()
+        content_parts = []
+        traceback = []
+        try:
+            async with rag_balancers[self.backend].instance() as instance:
+                async for chunk in stream_answer_request(
+                    session=self.session,
+                    pydantic_model=answer_generation_credentials,
+                    endpoint=instance.url,
+                ):
+                    if chunk.get("content"):
+                        content_parts.append(chunk["content"])
+                        await self.websocket.send_json(
+                            {"event": "chunk", "content": chunk["content"]}
+                        )
+                    if chunk.get("traceback") is not None:
+                        traceback = chunk["traceback"]
+        except HTTPException as http_exception:
+            await self.send_error(http_exception)
+            return None
+
+        answer = AIMessage(content="".join(content_parts), traceback=traceback)
+        await cache_answer(
+            answer_generation_credentials,
+            answer,
+            latency=time.perf_counter() - started_at,
+            generation=generation,
+        )
+        return answer
+
+    async def send_error(self, http_exception: HTTPException) -> None:
+        await self.websocket.send_json(
+            {
+                "event": "error",
+                "status_code": http_exception.status_code,
+                "detail": http_exception.detail,
+            }
+        )
+
+    async def remember(self, query: str, answer: AIMessage | None) -> None:
+        messages = [UserMessageResponse(content=query, role="user")]
+        if answer is not None:
+            messages.append(AIMessageResponse(**answer.model_dump(), role="ai"))
+
+        counts = await count_tokens([message.content for message in messages])
+        self.history.extend(messages)
+        for count in counts:
+            self.prefix_sums.append(self.prefix_sums[-1] + count)
+
+        if answer is None:
+            add_message_error = await add_user_message(
+                chat_id=self.chat_id, query=query
+            )
+        else:
+            add_message_error = await add_exchange(
+                chat_id=self.chat_id, query=query, answer=answer
+            )
+
+        if add_message_error is not None:
+            await self.websocket.send_json(
+                {
+                    "event": "persistence_error",
+                    "add_message_exception": make_exception(add_message_error),
+                }
+            )
@@ -1,138 +1,269 @@
+import logging
+import time
+import uuid
+from typing import Any, Coroutine, Literal, TypeVar
 import aiohttp
+from fastapi import HTTPException, Request
 from ..requests.qa import get_answer_request
-from ..schemas.qa import GenerationCredentials, AnswerGenerationCredentials, ModelAnswer
-from src.services.vaults.schemas.vault import VaultCredentials
+from ..schemas.qa import (
+    GenerationCredentials,
+    AnswerGenerationCredentials,
+    GenerationContext,
+    ModelAnswer,
+)
+from src.services.vaults.schemas.vault import VaultCredentials, VaultType
 from src.services.messaging.schemas.chat import ChatCredentials
 from src.services.messaging.schemas.history import (
-    AddUserMessage,
-    AddAIMessage,
+    AIMessage,
     AIMessageResponse,
     UserMessage,
+    UserMessageResponse,
 )
-from src.services.messaging.requests.history_service import (
-    add_user_message_request,
-    add_ai_message_request,
-)
+from src.services.messaging.utils.history_writer import history_writer
 from ..utils import truncate_history
-from ..requests.external_endpoints import rag_endpoints
+from ..utils.history import append_history_tokens
+from ..utils.cache import answer_cache_manager
+from ..utils.scheduler import schedulers, SchedulerRejection, Ticket
+from ..utils.balancer import rag_balancers
+from ..utils.chat_lock import chat_lock
+from ..config import settings
+from src.metrics import metrics
 import asyncio
 
 from src.services.messaging.service.messaging import MessagingService
 from ...vaults.service.vaults import VaultsService
 
+T = TypeVar("T")
 
-async def generate_answer(
+
+def make_exception(error: str | None) -> dict[bool, str]:
+    return {True: error} if error is not None else {False: ""}
+
+
+async def prepare_history(
+    messaging_service: MessagingService,
+    chat_id: uuid.UUID,
+    session: aiohttp.ClientSession,
+) -> tuple[list[UserMessageResponse | AIMessageResponse], str | None]:
+    try:
+        chat_history = await messaging_service.get_chat_history(
+            session=session, chat_credentials=ChatCredentials(chat_id=chat_id)
+        )
+        history = await truncate_history(
+            chat_history.history, max_tokens=3000, chat_id=chat_id
+        )
+    except Exception as generic_error:
+        return [], str(generic_error)
+    return history, None
+
+
+async def prepare_generation(
     messaging_service: MessagingService,
     vaults_service: VaultsService,
     generation_credentials: GenerationCredentials,
     session: aiohttp.ClientSession,
-) -> ModelAnswer:
-    await messaging_service.cache_manager.delete_chat(
-        chat_id=generation_credentials.chat_id
-    )
-
-    history_error = None
+) -> GenerationContext:
     vault_error = None
-    add_user_message_error = None
-    add_ai_message_error = None
 
-    vault_credentials = VaultCredentials(vault_id=generation_credentials.vault_id)
-    chat_credentials = ChatCredentials(chat_id=generation_credentials.chat_id)
+    get_vault_type = vaults_service.get_vault_type(
+        session=session,
+        vault_credentials=VaultCredentials(vault_id=generation_credentials.vault_id),
+    )
+    get_history = prepare_history(
+        messaging_service=messaging_service,
+        chat_id=generation_credentials.chat_id,
+        session=session,
+    )
 
-    get_vault = vaults_service.get_vault(
-        session=session, vault_credentials=vault_credentials
+    vault_type, (history, history_error) = await asyncio.gather(
+        get_vault_type, get_history, return_exceptions=True
     )
-    get_history = messaging_service.get_chat_history(
-        session=session, chat_credentials=chat_credentials
+
+    if isinstance(vault_type, Exception):
+        vault_error = str(vault_type)
+        vault_type = None
+
+    answer_generation_credentials = AnswerGenerationCredentials(
+        vault_id=generation_credentials.vault_id if vault_type is not None else None,
+        query=generation_credentials.query,
+        history=history,
     )
 
-    vault_payload, chat_history = await asyncio.gather(
-        get_vault, get_history, return_exceptions=True
+    return GenerationContext(
+        answer_generation_credentials=answer_generation_credentials,
+        backend="vector" if vault_type == VaultType.VECTOR else "graph",
+        history_error=history_error,
+        vault_error=vault_error,
     )
 
+
+async def get_cached_answer(
+    credentials: AnswerGenerationCredentials,
+) -> tuple[AIMessage | None, str | None]:
     try:
-        await add_user_message_request(
-            session=session,
-            pydantic_model=AddUserMessage(
-                chat_id=generation_credentials.chat_id,
-                message=UserMessage(content=generation_credentials.query),
-            ),
+        return await answer_cache_manager.get_answer(credentials)
+    except Exception as generic_error:
+        logging.error(f"Answer cache error: {generic_error}")
+        return None, None
+
+
+async def cache_answer(
+    credentials: AnswerGenerationCredentials,
+    answer: AIMessage,
+    latency: float,
+    generation: str | None,
+) -> None:
+    try:
+        await answer_cache_manager.set_answer(
+            credentials, answer, latency=latency, generation=generation
         )
     except Exception as generic_error:
-        add_user_message_error = str(generic_error)
+        logging.error(f"Answer cache error: {generic_error}")
+    return
 
-    if isinstance(chat_history, Exception):
-        history_error = str(chat_history)
-        chat_history = None
 
-    if isinstance(vault_payload, Exception):
-        vault_error = str(vault_payload)
-        vault_payload = None
+async def request_answer(
+    user_id: uuid.UUID,
+    backend: Literal["graph", "vector"],
+    credentials: AnswerGenerationCredentials,
+    session: aiohttp.ClientSession,
+    background: bool = False,
+) -> tuple[AIMessage, Ticket]:
+    ticket = Ticket(user_id=user_id)
+    answer, generation = await get_cached_answer(credentials)
+    if answer is None:
+        async with schedulers[backend].slot(
+            user_id=user_id, background=background
+        ) as ticket:
+            started_at = time.perf_counter()
+            async with rag_balancers[backend].instance() as instance:
+                answer = await get_answer_request(
+                    session=session, pydantic_model=credentials, endpoint=instance.url
+                )
+        await cache_answer(
+            credentials,
+            answer,
+            latency=time.perf_counter() - started_at,
+            generation=generation,
+        )
+    return answer, ticket
 
-    history = (
-        await truncate_history(chat_history.history, max_tokens=3000)
-        if chat_history is not None
-        else []
-    )
 
-    answer_generation_credentials = AnswerGenerationCredentials(
-        vault_id=vault_payload.id if vault_payload is not None else None,
-        query=generation_credentials.query,
-        history=history,
-    )
+async def add_user_message(chat_id: uuid.UUID, query: str) -> str | None:
+    try:
+        await history_writer.add_user_message(
+            chat_id=chat_id, message=UserMessage(content=query)
+        )
+    except Exception as generic_error:
+        return str(generic_error)
 
-    answer = None
-    if vault_payload is None:
-        answer = await get_answer_request(
-            session=session,
-            pydantic_model=answer_generation_credentials,
-            endpoint=rag_endpoints.graph_answer,
+    await append_history_tokens(chat_id=chat_id, contents=[query])
+    return None
+
+
+async def add_exchange(chat_id: uuid.UUID, query: str, answer: AIMessage) -> str | None:
+    try:
+        await history_writer.add_exchange(
+            chat_id=chat_id,
+            user_message=UserMessage(content=query),
+            ai_message=answer,
         )
-    else:
-        if vault_payload.type == "graph":
-            answer = await get_answer_request(
-                session=session,
-                pydantic_model=answer_generation_credentials,
-                endpoint=rag_endpoints.graph_answer,
-            )
+    except Exception as generic_error:
+        return str(generic_error)
+
+    await append_history_tokens(chat_id=chat_id, contents=[query, answer.content])
+    return None
+
+
+async def add_cancelled_exchange(
+    chat_id: uuid.UUID, query: str, content: str = ""
+) -> None:
+    policy = settings.cancellation.cancelled_exchange_policy
+    if policy == "partial" and content:
+        await add_exchange(
+            chat_id=chat_id,
+            query=query,
+            answer=AIMessage(content=content, traceback=[]),
+        )
+    elif policy != "discard":
+        await add_user_message(chat_id=chat_id, query=query)
+    return
 
-        if vault_payload.type == "vector":
-            answer = await get_answer_request(
-                session=session,
-                pydantic_model=answer_generation_credentials,
-                endpoint=rag_endpoints.vector_answer,
-            )
 
+async def cancel_on_disconnect(
+    request: Request, generation: Coroutine[Any, Any, T]
+) -> T:
+    task = asyncio.ensure_future(generation)
     try:
-        await add_ai_message_request(
+        while True:
+            done, _ = await asyncio.wait(
+                {task}, timeout=settings.cancellation.disconnect_poll_interval
+            )
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                break
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+    metrics.increment("rag.generation.cancelled")
+    raise HTTPException(status_code=499, detail="Client closed request")
+
+
+async def generate_answer(
+    user_id: uuid.UUID,
+    messaging_service: MessagingService,
+    vaults_service: VaultsService,
+    generation_credentials: GenerationCredentials,
+    session: aiohttp.ClientSession,
+) -> ModelAnswer:
+    async with chat_lock.hold(chat_id=generation_credentials.chat_id):
+        context = await prepare_generation(
+            messaging_service=messaging_service,
+            vaults_service=vaults_service,
+            generation_credentials=generation_credentials,
             session=session,
-            pydantic_model=AddAIMessage(
-                chat_id=generation_credentials.chat_id,
-                message=answer,
-            ),
         )
-    except Exception as generic_error:
-        add_ai_message_error = str(generic_error)
 
-    history_exception = (
-        {True: history_error} if history_error is not None else {False: ""}
-    )
-    vault_exception = {True: vault_error} if vault_error is not None else {False: ""}
-    add_ai_message_exception = (
-        {True: add_ai_message_error}
-        if add_ai_message_error is not None
-        else {False: ""}
-    )
-    add_user_message_exception = (
-        {True: add_user_message_error}
-        if add_user_message_error is not None
-        else {False: ""}
-    )
+        try:
+            answer, ticket = await request_answer(
+                user_id=user_id,
+                backend=context.backend,
+                credentials=context.answer_generation_credentials,
+                session=session,
+            )
+        except SchedulerRejection:
+            raise
+        except asyncio.CancelledError:
+            await asyncio.shield(
+                add_cancelled_exchange(
+                    chat_id=generation_credentials.chat_id,
+                    query=generation_credentials.query,
+                )
+            )
+            raise
+        except Exception:
+            await add_user_message(
+                chat_id=generation_credentials.chat_id,
+                query=generation_credentials.query,
+            )
+            raise
 
-    return ModelAnswer(
-        ai_message=AIMessageResponse(**answer.model_dump(), role="ai"),
-        history_exception=history_exception,
-        vault_exception=vault_exception,
-        add_ai_message_exception=add_ai_message_exception,
-        add_user_message_exception=add_user_message_exception,
-    )
+        add_exchange_error = await add_exchange(
+            chat_id=generation_credentials.chat_id,
+            query=generation_credentials.query,
+            answer=answer,
+        )
+
+        return ModelAnswer(
+            ai_message=AIMessageResponse(**answer.model_dump(), role="ai"),
+            history_exception=make_exception(context.history_error),
+            vault_exception=make_exception(context.vault_error),
+            add_ai_message_exception=make_exception(add_exchange_error),
+            add_user_message_exception=make_exception(add_exchange_error),
+            queue_position=ticket.position,
+            queue_wait=ticket.wait,
+        )
@@ -0,0 +1,178 @@
+import asyncio
+import uuid
+import aiohttp
+from fastapi import HTTPException, status
+from ..config import settings
+from ..schemas.qa import (
+    AnswerGenerationCredentials,
+    MultiVaultGenerationCredentials,
+    MultiVaultModelAnswer,
+    VaultAnswer,
+)
+from ..utils.chat_lock import chat_lock
+from src.metrics import metrics
+from src.services.messaging.schemas.history import (
+    AIMessage,
+    AIMessageResponse,
+    UserMessageResponse,
+)
+from src.services.messaging.service.messaging import MessagingService
+from src.services.vaults.schemas.vault import VaultCredentials, VaultType
+from ...vaults.service.vaults import VaultsService
+from .generate_answer import (
+    prepare_history,
+    request_answer,
+    add_user_message,
+    add_exchange,
+    add_cancelled_exchange,
+    make_exception,
+)
+
+
+async def answer_vault(
+    user_id: uuid.UUID,
+    vault_id: uuid.UUID,
+    query: str,
+    history: list[UserMessageResponse | AIMessageResponse],
+    vaults_service: VaultsService,
+    session: aiohttp.ClientSession,
+) -> AIMessage:
+    vault_type = await vaults_service.get_vault_type(
+        session=session, vault_credentials=VaultCredentials(vault_id=vault_id)
+    )
+    answer, _ = await request_answer(
+        user_id=user_id,
+        backend="vector" if vault_type == VaultType.VECTOR else "graph",
+        credentials=AnswerGenerationCredentials(
+            vault_id=vault_id, query=query, history=history
+        ),
+        session=session,
+    )
+    return answer
+
+
+def merge_answers(answers: list[AIMessage]) -> AIMessage:
+    return AIMessage(
+        content="\n\n".join(answer.content for answer in answers if answer.content),
+        traceback=[unit for answer in answers for unit in answer.traceback],
+    )
+
+
+async def generate_multi_vault_answer(
+    user_id: uuid.UUID,
+    messaging_service: MessagingService,
+    vaults_service: VaultsService,
+    generation_credentials: MultiVaultGenerationCredentials,
+    session: aiohttp.ClientSession,
+) -> MultiVaultModelAnswer:
+    async with chat_lock.hold(chat_id=generation_credentials.chat_id):
+        history, history_error = await prepare_history(
+            messaging_service=messaging_service,
+            chat_id=generation_credentials.chat_id,
+            session=session,
+        )
+
+        semaphore = asyncio.Semaphore(settings.fanout.fanout_concurrency)
+
+        async def answer_vault_bounded(vault_id: uuid.UUID) -> AIMessage:
+            async with semaphore:
+                return await answer_vault(
+                    user_id=user_id,
+                    vault_id=vault_id,
+                    query=generation_credentials.query,
+                    history=history,
+                    vaults_service=vaults_service,
+                    session=session,
+                )
+
+        tasks = {
+            vault_id: asyncio.create_task(answer_vault_bounded(vault_id))
+            for vault_id in dict.fromkeys(generation_credentials.vault_ids)
+        }
+        try:
+            _, pending = await asyncio.wait(
+                tasks.values(), timeout=settings.fanout.fanout_deadline
+            )
+        except asyncio.CancelledError:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.shield(
+                add_cancelled_exchange(
+                    chat_id=generation_credentials.chat_id,
+                    query=generation_credentials.query,
+                )
+            )
+            raise
+
+        # Vaults that missed the deadline are reported instead of holding up the rest
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        vault_answers = []
+        answers = []
+        for vault_id, task in tasks.items():
+            if task in pending:
+                metrics.increment("rag.fanout.timed_out")
+                vault_answers.append(
+                    VaultAnswer(
+                        vault_id=vault_id,
+                        ai_message=None,
+                        exception=make_exception(
+                            "Vault did not answer before deadline"
+                        ),
+                        timed_out=True,
+                    )
+                )
+            elif task.exception() is not None:
+                metrics.increment("rag.fanout.failed")
+                vault_answers.append(
+                    VaultAnswer(
+                        vault_id=vault_id,
+                        ai_message=None,
+                        exception=make_exception(str(task.exception())),
+                    )
+                )
+            else:
+                answers.append(task.result())
+                vault_answers.append(
+                    VaultAnswer(
+                        vault_id=vault_id,
+                        ai_message=AIMessageResponse(
+                            **task.result().model_dump(), role="ai"
+                        ),
+                        exception=make_exception(None),
+                    )
+                )
+
+        if not answers:
+            await add_user_message(
+                chat_id=generation_credentials.chat_id,
+                query=generation_credentials.query,
+            )
+            raise HTTPException(
+                status_code=(
+                    status.HTTP_504_GATEWAY_TIMEOUT
+                    if pending
+                    else status.HTTP_502_BAD_GATEWAY
+                ),
+                detail=[
+                    vault_answer.model_dump(mode="json")
+                    for vault_answer in vault_answers
+                ],
+            )
+
+        answer = merge_answers(answers)
+        add_exchange_error = await add_exchange(
+            chat_id=generation_credentials.chat_id,
+            query=generation_credentials.query,
+            answer=answer,
+        )
+
+        return MultiVaultModelAnswer(
+            ai_message=AIMessageResponse(**answer.model_dump(), role="ai"),
+            vault_answers=vault_answers,
+            history_exception=make_exception(history_error),
+            add_ai_message_exception=make_exception(add_exchange_error),
+            add_user_message_exception=make_exception(add_exchange_error),
+        )
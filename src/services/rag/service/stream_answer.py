@@ -0,0 +1,161 @@
+import asyncio
+import json
+import time
+import uuid
+from contextlib import aclosing
+from typing import AsyncIterator
+import aiohttp
+from fastapi import HTTPException
+from ..requests.qa import stream_answer_request
+from ..schemas.qa import GenerationCredentials, StreamedAnswerEnd
+from ..utils.scheduler import schedulers, Ticket
+from ..utils.balancer import rag_balancers
+from ..utils.chat_lock import chat_lock, ChatLockTimeout
+from src.services.messaging.schemas.history import AIMessage
+from src.services.messaging.service.messaging import MessagingService
+from ...vaults.service.vaults import VaultsService
+from .generate_answer import (
+    prepare_generation,
+    add_user_message,
+    add_exchange,
+    make_exception,
+    get_cached_answer,
+    cache_answer,
+    add_cancelled_exchange,
+)
+from src.metrics import metrics
+
+
+def make_event(event: str, data: str) -> str:
+    return f"event: {event}\ndata: {data}\n\n"
+
+
+async def stream_generation(
+    user_id: uuid.UUID,
+    messaging_service: MessagingService,
+    vaults_service: VaultsService,
+    generation_credentials: GenerationCredentials,
+    session: aiohttp.ClientSession,
+) -> AsyncIterator[str]:
+    context = await prepare_generation(
+        messaging_service=messaging_service,
+        vaults_service=vaults_service,
+        generation_credentials=generation_credentials,
+        session=session,
+    )
+
+    ticket = Ticket(user_id=user_id)
+    answer, generation = await get_cached_answer(context.answer_generation_credentials)
+    if answer is not None:
+        yield make_event("chunk", json.dumps({"content": answer.content}))
+    else:
+        admitted = False
+        content_parts = []
+        traceback = []
+        try:
+            async with schedulers[context.backend].slot(user_id=user_id) as ticket:
+                admitted = True
+                started_at = time.perf_counter()
+                yield make_event(
+                    "queue",
+                    json.dumps(
+                        {"queue_position": ticket.position, "queue_wait": ticket.wait}
+                    ),
+                )
+                async with rag_balancers[context.backend].instance() as instance:
+                    async for chunk in stream_answer_request(
+                        session=session,
+                        pydantic_model=context.answer_generation_credentials,
+                        endpoint=instance.url,
+                    ):
+                        if chunk.get("content"):
+                            content_parts.append(chunk["content"])
+                            yield make_event(
+                                "chunk", json.dumps({"content": chunk["content"]})
+                            )
+                        if chunk.get("traceback") is not None:
+                            traceback = chunk["traceback"]
+        except (asyncio.CancelledError, GeneratorExit):
+            metrics.increment("rag.generation.cancelled")
+            if admitted:
+                await asyncio.shield(
+                    add_cancelled_exchange(
+                        chat_id=generation_credentials.chat_id,
+                        query=generation_credentials.query,
+                        content="".join(content_parts),
+                    )
+                )
+            raise
+        except HTTPException as http_exception:
+            # Questions rejected by the scheduler never reached the model
+            if admitted:
+                await add_user_message(
+                    chat_id=generation_credentials.chat_id,
+                    query=generation_credentials.query,
+                )
+            yield make_event(
+                "error",
+                json.dumps(
+                    {
+                        "status_code": http_exception.status_code,
+                        "detail": http_exception.detail,
+                    }
+                ),
+            )
+            return
+
+        answer = AIMessage(content="".join(content_parts), traceback=traceback)
+        await cache_answer(
+            context.answer_generation_credentials,
+            answer,
+            latency=time.perf_counter() - started_at,
+            generation=generation,
+        )
+
+    add_exchange_error = await add_exchange(
+        chat_id=generation_credentials.chat_id,
+        query=generation_credentials.query,
+        answer=answer,
+    )
+
+    answer_end = StreamedAnswerEnd(
+        traceback=answer.traceback,
+        history_exception=make_exception(context.history_error),
+        vault_exception=make_exception(context.vault_error),
+        add_ai_message_exception=make_exception(add_exchange_error),
+        add_user_message_exception=make_exception(add_exchange_error),
+        queue_position=ticket.position,
+        queue_wait=ticket.wait,
+    )
+    yield make_event("end", answer_end.model_dump_json())
+
+
+async def stream_answer(
+    user_id: uuid.UUID,
+    messaging_service: MessagingService,
+    vaults_service: VaultsService,
+    generation_credentials: GenerationCredentials,
+    session: aiohttp.ClientSession,
+) -> AsyncIterator[str]:
+    # The generation is closed inside the hold, so a disconnected client's partial
+    # answer is recorded before the next question of the chat may start
+    try:
+        async with chat_lock.hold(chat_id=generation_credentials.chat_id):
+            async with aclosing(
+                stream_generation(
+                    user_id=user_id,
+                    messaging_service=messaging_service,
+                    vaults_service=vaults_service,
+                    generation_credentials=generation_credentials,
+                    session=session,
+                )
+            ) as events:
+                async for event in events:
+                    yield event
+    except ChatLockTimeout as lock_timeout:
+        yield make_event(
+            "error",
+            json.dumps(
+                {"status_code": lock_timeout.status_code, "detail": lock_timeout.detail}
+            ),
+        )
@@ -0,0 +1 @@
+from .history import truncate_history
@@ -0,0 +1,119 @@
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import AsyncIterator, Literal
+from urllib.parse import urlsplit
+from fastapi import HTTPException
+from src.metrics import metrics
+from ..config import settings
+from ..requests.external_endpoints import rag_endpoints
+
+
+@dataclass(eq=False)
+class RagInstance:
+    url: str
+    outstanding: int = 0
+    latency: float = 0.0
+    failures: int = 0
+    ejected_until: float = 0.0
+
+    @property
+    def name(self) -> str:
+        return urlsplit(self.url).netloc
+
+    def is_healthy(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+
+class RagBalancer:
+    def __init__(
+        self,
+        backend: str,
+        urls: list[str],
+        strategy: Literal["least_outstanding", "power_of_two"],
+        failure_threshold: int,
+        ejection_time: float,
+        latency_decay: float,
+    ):
+        self.backend = backend
+        self.instances = [RagInstance(url=url) for url in urls]
+        self.strategy = strategy
+        self.failure_threshold = failure_threshold
+        self.ejection_time = ejection_time
+        self.latency_decay = latency_decay
+
+    @staticmethod
+    def load(instance: RagInstance) -> tuple[int, float]:
+        return instance.outstanding, instance.latency
+
+    def pick(self) -> RagInstance:
+        now = time.monotonic()
+        # With every instance ejected it is still better to try one than to fail outright
+        candidates = [
+            instance for instance in self.instances if instance.is_healthy(now)
+        ] or self.instances
+        if self.strategy == "power_of_two" and len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        return min(candidates, key=self.load)
+
+    def succeed(self, instance: RagInstance, latency: float) -> None:
+        instance.failures = 0
+        instance.latency = (
+            latency
+            if instance.latency == 0
+            else (1 - self.latency_decay) * instance.latency
+            + self.latency_decay * latency
+        )
+        metrics.observe(f"rag.balancer.{self.backend}.{instance.name}.latency", latency)
+
+    def fail(self, instance: RagInstance) -> None:
+        instance.failures += 1
+        metrics.increment(f"rag.balancer.{self.backend}.{instance.name}.failures")
+        if instance.failures >= self.failure_threshold:
+            instance.failures = 0
+            instance.ejected_until = time.monotonic() + self.ejection_time
+            metrics.increment(f"rag.balancer.{self.backend}.{instance.name}.ejections")
+            logging.warning(
+                f"{self.backend} RAG instance {instance.name} ejected "
+                f"for {self.ejection_time} seconds"
+            )
+
+    @asynccontextmanager
+    async def instance(self) -> AsyncIterator[RagInstance]:
+        instance = self.pick()
+        instance.outstanding += 1
+        started_at = time.perf_counter()
+        try:
+            yield instance
+        except HTTPException as http_exception:
+            # Request errors are already mapped to HTTPException, client errors say
+            # nothing about the health of the instance
+            if http_exception.status_code >= 500:
+                self.fail(instance)
+            raise
+        else:
+            self.succeed(instance, latency=time.perf_counter() - started_at)
+        finally:
+            instance.outstanding -= 1
+            metrics.set_gauge(
+                f"rag.balancer.{self.backend}.{instance.name}.outstanding",
+                instance.outstanding,
+            )
+
+
+rag_balancers = {
+    backend: RagBalancer(
+        backend=backend,
+        urls=urls,
+        strategy=settings.balancer.balancer_strategy,
+        failure_threshold=settings.balancer.balancer_failure_threshold,
+        ejection_time=settings.balancer.balancer_ejection_time,
+        latency_decay=settings.balancer.balancer_latency_decay,
+    )
+    for backend, urls in (
+        ("graph", rag_endpoints.graph_answer),
+        ("vector", rag_endpoints.vector_answer),
+    )
+}
@@ -0,0 +1,349 @@
+import asyncio
+import hashlib
+import json
+import uuid
+from collections import OrderedDict
+from src.repositories.redis import RedisRepository
+from src.metrics import metrics
+from ..config import settings
+from ..schemas.qa import AnswerGenerationCredentials, BatchJobStatus, BatchResult
+from ...messaging.schemas.history import AIMessage
+
+
+class TokenCountCache:
+    def __init__(
+        self, redis_repository: type(RedisRepository), max_entries: int, ttl: int
+    ):
+        self.redis: RedisRepository = redis_repository()
+        self.cache_prefix = "rag:"
+        self.tokens_prefix = "tokens:"
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.counts: OrderedDict[str, int] = OrderedDict()
+
+    @staticmethod
+    def make_digest(content: str) -> str:
+        return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+    def _remember(self, digest: str, count: int) -> None:
+        self.counts[digest] = count
+        self.counts.move_to_end(digest)
+        while len(self.counts) > self.max_entries:
+            self.counts.popitem(last=False)
+
+    async def get_counts(self, digests: list[str]) -> dict[str, int]:
+        found = dict()
+        missing = []
+        for digest in digests:
+            count = self.counts.get(digest)
+            if count is None:
+                missing.append(digest)
+            else:
+                self.counts.move_to_end(digest)
+                found[digest] = count
+        metrics.increment("rag.token_cache.l1_hits", len(found))
+
+        if missing:
+            results = await self.redis.get_many(
+                [
+                    f"{self.cache_prefix}{self.tokens_prefix}{digest}"
+                    for digest in missing
+                ]
+            )
+            l2_hits = 0
+            for digest, result in zip(missing, results):
+                if result is not None:
+                    l2_hits += 1
+                    found[digest] = int(result)
+                    self._remember(digest, int(result))
+            metrics.increment("rag.token_cache.l2_hits", l2_hits)
+            metrics.increment("rag.token_cache.misses", len(missing) - l2_hits)
+
+        metrics.set_gauge("rag.token_cache.l1_size", len(self.counts))
+        return found
+
+    async def set_counts(self, counts: dict[str, int]) -> None:
+        for digest, count in counts.items():
+            self._remember(digest, count)
+        metrics.set_gauge("rag.token_cache.l1_size", len(self.counts))
+        await self.redis.set_many(
+            {
+                f"{self.cache_prefix}{self.tokens_prefix}{digest}": str(count)
+                for digest, count in counts.items()
+            },
+            ttl=self.ttl,
+        )
+        return
+
+
+class HistoryTokenIndex:
+    # Each element is "<prefix sum>:<digest>", the first one is the "0:" sentinel
+    append_script = """
+    local last = redis.call('LINDEX', KEYS[1], -1)
+    if not last then
+        return -1
+    end
+    local total = tonumber(string.match(last, '^(%d+)'))
+    for i = 2, #ARGV, 2 do
+        total = total + tonumber(ARGV[i])
+        redis.call('RPUSH', KEYS[1], total .. ':' .. ARGV[i + 1])
+    end
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    return total
+    """
+    # Walks back from the end in short ranges to the last message whose prefix sum
+    # leaves at most ARGV[3] tokens after it, so a long history is never read whole
+    cut_script = """
+    local length = redis.call('LLEN', KEYS[1])
+    if length ~= tonumber(ARGV[1]) + 1 then
+        return false
+    end
+    local total, digest = string.match(redis.call('LINDEX', KEYS[1], -1), '^(%d+):(.*)$')
+    if ARGV[2] ~= '' and digest ~= ARGV[2] then
+        return false
+    end
+    local threshold = tonumber(total) - tonumber(ARGV[3])
+    if threshold < 0 then
+        return -1
+    end
+    local stop = length - 2
+    while stop >= 0 do
+        local start = math.max(0, stop - 31)
+        local elements = redis.call('LRANGE', KEYS[1], start, stop)
+        for i = #elements, 1, -1 do
+            if tonumber(string.match(elements[i], '^(%d+)')) <= threshold then
+                return start + i - 1
+            end
+        end
+        stop = start - 1
+    end
+    return -1
+    """
+
+    def __init__(self, redis_repository: type(RedisRepository), ttl: int):
+        self.redis: RedisRepository = redis_repository()
+        self.cache_prefix = "rag:"
+        self.index_prefix = "history_tokens:"
+        self.ttl = ttl
+
+    async def get_prefix_sums(
+        self, chat_id: uuid.UUID, last_digest: str | None, length: int
+    ) -> None | list[int]:
+        result = await self.redis.get_list(
+            f"{self.cache_prefix}{self.index_prefix}{chat_id.hex}"
+        )
+        if len(result) != length + 1:
+            return None
+
+        prefix_sums = []
+        digest = None
+        for element in result:
+            prefix_sum, digest = element.split(":", 1)
+            prefix_sums.append(int(prefix_sum))
+
+        if last_digest is not None and digest != last_digest:
+            return None
+        return prefix_sums
+
+    async def get_cut(
+        self,
+        chat_id: uuid.UUID,
+        last_digest: str | None,
+        length: int,
+        max_tokens: int,
+    ) -> None | int:
+        return await self.redis.eval_script(
+            self.cut_script,
+            keys=[f"{self.cache_prefix}{self.index_prefix}{chat_id.hex}"],
+            args=[length, last_digest or "", max_tokens],
+        )
+
+    async def set_prefix_sums(
+        self, chat_id: uuid.UUID, prefix_sums: list[int], last_digest: str | None
+    ) -> None:
+        elements = [f"{prefix_sum}:" for prefix_sum in prefix_sums]
+        if last_digest is not None:
+            elements[-1] = f"{prefix_sums[-1]}:{last_digest}"
+        await self.redis.replace_list(
+            f"{self.cache_prefix}{self.index_prefix}{chat_id.hex}",
+            elements,
+            ttl=self.ttl,
+        )
+        return
+
+    async def append(
+        self, chat_id: uuid.UUID, digests: list[str], counts: list[int]
+    ) -> None:
+        args = [self.ttl]
+        for digest, count in zip(digests, counts):
+            args.extend([count, digest])
+        await self.redis.eval_script(
+            self.append_script,
+            keys=[f"{self.cache_prefix}{self.index_prefix}{chat_id.hex}"],
+            args=args,
+        )
+        return
+
+    async def delete(self, chat_id: uuid.UUID) -> bool:
+        return await self.redis.delete(
+            f"{self.cache_prefix}{self.index_prefix}{chat_id.hex}"
+        )
+
+
+class AnswerCache:
+    def __init__(
+        self, redis_repository: type(RedisRepository), enabled: bool, ttl: int
+    ):
+        self.redis: RedisRepository = redis_repository()
+        self.cache_prefix = "rag:"
+        self.answers_prefix = "answers:"
+        self.answers_tag_prefix = "answers_tag:"
+        self.generation_prefix = "answers_generation:"
+        self.enabled = enabled
+        self.ttl = ttl
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        return " ".join(query.casefold().split())
+
+    def make_key(self, credentials: AnswerGenerationCredentials) -> str:
+        history = [
+            (message.role, message.content) for message in credentials.history or []
+        ]
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.normalize_query(credentials.query).encode())
+        digest.update(b"\0")
+        digest.update(json.dumps(history, ensure_ascii=False).encode())
+        return (
+            f"{self.cache_prefix}{self.answers_prefix}"
+            f"{credentials.vault_id.hex}:{digest.hexdigest()}"
+        )
+
+    async def get_answer(
+        self, credentials: AnswerGenerationCredentials
+    ) -> tuple[AIMessage | None, str | None]:
+        # A miss also returns the generation of the vault, set_answer needs it to
+        # refuse answers computed before the vault changed
+        if not self.enabled or credentials.vault_id is None:
+            return None, None
+
+        result, generation = await self.redis.get_many(
+            [
+                self.make_key(credentials),
+                self.make_generation_key(credentials.vault_id),
+            ]
+        )
+        if result is None:
+            metrics.increment("rag.answer_cache.misses")
+            return None, generation or "0"
+
+        cached = json.loads(result)
+        metrics.increment("rag.answer_cache.hits")
+        metrics.increment("rag.answer_cache.latency_saved_seconds", cached["latency"])
+        return AIMessage(**cached["answer"]), None
+
+    async def set_answer(
+        self,
+        credentials: AnswerGenerationCredentials,
+        answer: AIMessage,
+        latency: float,
+        generation: str | None,
+    ) -> None:
+        if not self.enabled or credentials.vault_id is None or generation is None:
+            return
+        stored = await self.redis.set_tagged(
+            self.make_key(credentials),
+            json.dumps({"answer": answer.model_dump(mode="json"), "latency": latency}),
+            tag=self.make_tag(credentials.vault_id),
+            ttl=self.ttl,
+            guard=(self.make_generation_key(credentials.vault_id), generation),
+        )
+        if not stored:
+            metrics.increment("rag.answer_cache.stale_skipped")
+        return
+
+    def make_tag(self, vault_id: uuid.UUID) -> str:
+        return f"{self.cache_prefix}{self.answers_tag_prefix}{vault_id.hex}"
+
+    def make_generation_key(self, vault_id: uuid.UUID) -> str:
+        return f"{self.cache_prefix}{self.generation_prefix}{vault_id.hex}"
+
+    async def delete_answers(self, vault_id: uuid.UUID) -> None:
+        # Bumped first, answers still being generated for the vault are not stored
+        await self.redis.increment(self.make_generation_key(vault_id), ttl=self.ttl)
+        await self.redis.delete_by_tag(self.make_tag(vault_id))
+        return
+
+
+class BatchJobStore:
+    def __init__(self, redis_repository: type(RedisRepository), ttl: int):
+        self.redis: RedisRepository = redis_repository()
+        self.cache_prefix = "rag:"
+        self.job_prefix = "batch:"
+        self.results_prefix = "batch_results:"
+        self.ttl = ttl
+
+    async def set_job(self, user_id: uuid.UUID, job_status: BatchJobStatus) -> bool:
+        job = job_status.model_dump(mode="json", exclude={"results"})
+        job["user_id"] = user_id.hex
+        return await self.redis.set(
+            f"{self.cache_prefix}{self.job_prefix}{job_status.job_id.hex}",
+            json.dumps(job),
+            ttl=self.ttl,
+        )
+
+    async def create_job(self, user_id: uuid.UUID, job_status: BatchJobStatus) -> None:
+        # The results list starts with an empty sentinel so that it exists before the first result
+        await self.redis.replace_list(
+            f"{self.cache_prefix}{self.results_prefix}{job_status.job_id.hex}",
+            [""],
+            ttl=self.ttl,
+        )
+        await self.set_job(user_id=user_id, job_status=job_status)
+        return
+
+    async def add_result(self, job_id: uuid.UUID, result: BatchResult) -> None:
+        await self.redis.append_list_if_exists(
+            f"{self.cache_prefix}{self.results_prefix}{job_id.hex}",
+            [result.model_dump_json()],
+            ttl=self.ttl,
+        )
+        return
+
+    async def get_job(
+        self, job_id: uuid.UUID
+    ) -> tuple[None, None] | tuple[uuid.UUID, BatchJobStatus]:
+        job, results = await asyncio.gather(
+            self.redis.get(f"{self.cache_prefix}{self.job_prefix}{job_id.hex}"),
+            self.redis.get_list(
+                f"{self.cache_prefix}{self.results_prefix}{job_id.hex}"
+            ),
+        )
+        if job is None:
+            return None, None
+
+        job = json.loads(job)
+        user_id = uuid.UUID(job.pop("user_id"))
+        job_status = BatchJobStatus(**job)
+        job_status.results = sorted(
+            (BatchResult.model_validate_json(result) for result in results[1:]),
+            key=lambda result: result.index,
+        )
+        job_status.completed = len(job_status.results)
+        return user_id, job_status
+
+
+token_count_cache_manager = TokenCountCache(
+    RedisRepository,
+    max_entries=settings.token_cache.token_cache_max_entries,
+    ttl=settings.token_cache.token_cache_ttl,
+)
+history_token_index = HistoryTokenIndex(
+    RedisRepository, ttl=settings.token_cache.history_token_index_ttl
+)
+answer_cache_manager = AnswerCache(
+    RedisRepository,
+    enabled=settings.answer_cache.answer_cache_enabled,
+    ttl=settings.answer_cache.answer_cache_ttl,
+)
+batch_job_store = BatchJobStore(RedisRepository, ttl=settings.batch.batch_result_ttl)
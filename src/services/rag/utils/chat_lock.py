@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from fastapi import HTTPException, status
+from redis.exceptions import LockError
+from src.metrics import metrics
+from src.repositories.redis import RedisRepository
+from src.services.messaging.utils.cache import messaging_cache_manager
+from src.services.messaging.utils.history_writer import history_writer
+from ..config import settings
+
+
+class ChatLockTimeout(HTTPException):
+    pass
+
+
+class ChatLock:
+    # Serializes generations of one chat across workers, so every question is
+    # answered against a history that already contains the previous exchange.
+    # The lease is renewed while the holder runs and only lapses if it dies
+    def __init__(
+        self,
+        redis_repository: type(RedisRepository),
+        timeout: float,
+        wait: float,
+        settle_timeout: float,
+    ):
+        self.redis: RedisRepository = redis_repository()
+        self.cache_prefix = "rag:"
+        self.lock_prefix = "chat_lock:"
+        self.timeout = timeout
+        self.wait = wait
+        self.settle_timeout = settle_timeout
+
+    async def settle(self, chat_id: uuid.UUID) -> None:
+        # Without a cached history the next holder reads the history service,
+        # which only has the exchange once the history writer has flushed it
+        try:
+            if await messaging_cache_manager.has_history(chat_id=chat_id):
+                return
+            await asyncio.wait_for(
+                history_writer.flushed(chat_id=chat_id), timeout=self.settle_timeout
+            )
+        except Exception as generic_error:
+            logging.error(f"Chat history did not settle: {generic_error}")
+
+    @staticmethod
+    async def release(lock) -> None:
+        try:
+            await lock.release()
+        except LockError as lock_error:
+            logging.error(f"Chat lock lease expired before release: {lock_error}")
+
+    @asynccontextmanager
+    async def hold(self, chat_id: uuid.UUID) -> AsyncIterator[None]:
+        lock = self.redis.lock(
+            f"{self.cache_prefix}{self.lock_prefix}{chat_id.hex}",
+            timeout=self.timeout,
+            blocking_timeout=self.wait,
+        )
+        started_at = time.perf_counter()
+        try:
+            acquired = await lock.acquire()
+        except Exception as generic_error:
+            logging.error(f"Chat lock error: {generic_error}")
+            acquired = None
+        metrics.observe("rag.chat_lock.wait", time.perf_counter() - started_at)
+
+        # A Redis outage should not take generation down with it
+        if acquired is None:
+            yield
+            return
+        if not acquired:
+            metrics.increment("rag.chat_lock.timeouts")
+            raise ChatLockTimeout(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Another answer is still being generated for this chat",
+            )
+
+        try:
+            async with self.redis.renewing(lock):
+                try:
+                    yield
+                finally:
+                    await asyncio.shield(self.settle(chat_id=chat_id))
+        finally:
+            await asyncio.shield(self.release(lock=lock))
+
+
+chat_lock = ChatLock(
+    RedisRepository,
+    timeout=settings.chat_lock.chat_lock_timeout,
+    wait=settings.chat_lock.chat_lock_wait,
+    settle_timeout=settings.chat_lock.chat_lock_settle_timeout,
+)
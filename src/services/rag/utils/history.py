@@ -0,0 +1,113 @@
+import logging
+import uuid
+from bisect import bisect_right
+from itertools import accumulate
+from ...messaging.schemas.history import UserMessageResponse, AIMessageResponse
+from .cache import token_count_cache_manager, history_token_index
+from .tokenizer import tokenizer_service
+
+
+async def count_tokens(contents: list[str]) -> list[int]:
+    digests = [token_count_cache_manager.make_digest(content) for content in contents]
+    counts = await token_count_cache_manager.get_counts(list(set(digests)))
+
+    uncached = dict()
+    for digest, content in zip(digests, contents):
+        if digest not in counts:
+            uncached[digest] = content
+
+    if uncached:
+        new_counts = dict(
+            zip(
+                uncached.keys(),
+                await tokenizer_service.count_tokens(list(uncached.values())),
+            )
+        )
+        await token_count_cache_manager.set_counts(new_counts)
+        counts.update(new_counts)
+
+    return [counts[digest] for digest in digests]
+
+
+async def count_history_tokens(
+    history: list[UserMessageResponse | AIMessageResponse],
+) -> list[int]:
+    return await count_tokens([message.content for message in history])
+
+
+async def append_history_tokens(chat_id: uuid.UUID, contents: list[str]) -> None:
+    # The index is rebuilt on the next truncation if it falls out of sync
+    try:
+        counts = await count_tokens(contents)
+        digests = [
+            token_count_cache_manager.make_digest(content) for content in contents
+        ]
+        await history_token_index.append(
+            chat_id=chat_id, digests=digests, counts=counts
+        )
+    except Exception as generic_error:
+        logging.error(f"Failed to append history token counts: {generic_error}")
+    return
+
+
+def make_last_digest(
+    history: list[UserMessageResponse | AIMessageResponse],
+) -> str | None:
+    return (
+        token_count_cache_manager.make_digest(history[-1].content) if history else None
+    )
+
+
+async def get_history_prefix_sums(
+    history: list[UserMessageResponse | AIMessageResponse],
+    chat_id: uuid.UUID | None = None,
+) -> list[int]:
+    last_digest = make_last_digest(history)
+    if chat_id is not None:
+        prefix_sums = await history_token_index.get_prefix_sums(
+            chat_id=chat_id, last_digest=last_digest, length=len(history)
+        )
+        if prefix_sums is not None:
+            return prefix_sums
+
+    counts = await count_history_tokens(history)
+    prefix_sums = list(accumulate(counts, initial=0))
+    if chat_id is not None:
+        await history_token_index.set_prefix_sums(
+            chat_id=chat_id, prefix_sums=prefix_sums, last_digest=last_digest
+        )
+    return prefix_sums
+
+
+def truncate_by_prefix_sums(
+    history: list[UserMessageResponse | AIMessageResponse | None],
+    prefix_sums: list[int],
+    max_tokens: int,
+):
+    # Cut right after the last message i whose suffix sum prefix_sums[n] - prefix_sums[i]
+    # reaches max_tokens, the same point the backwards linear scan stops at
+    n = len(history)
+    i = bisect_right(prefix_sums, prefix_sums[n] - max_tokens, 0, n) - 1
+    if i < 0:
+        return history  # Return the original list if sum does not exceed max_tokens
+    return history[i + 1 :]
+
+
+async def truncate_history(
+    history: list[UserMessageResponse | AIMessageResponse | None],
+    max_tokens=7000,
+    chat_id: uuid.UUID | None = None,
+):
+    # The index finds the cut on its own, the prefix sums are only needed to rebuild it
+    if chat_id is not None:
+        cut = await history_token_index.get_cut(
+            chat_id=chat_id,
+            last_digest=make_last_digest(history),
+            length=len(history),
+            max_tokens=max_tokens,
+        )
+        if cut is not None:
+            return history if cut < 0 else history[cut + 1 :]
+
+    prefix_sums = await get_history_prefix_sums(history, chat_id=chat_id)
+    return truncate_by_prefix_sums(history, prefix_sums, max_tokens)
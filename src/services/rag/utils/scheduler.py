@@ -0,0 +1,197 @@
+import asyncio
+import math
+import time
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator
+from fastapi import HTTPException, status
+from src.metrics import metrics
+from ..config import settings
+
+
+class SchedulerRejection(HTTPException):
+    pass
+
+
+@dataclass(eq=False)
+class Ticket:
+    user_id: uuid.UUID
+    position: int = 0
+    wait: float = 0.0
+    granted: asyncio.Future = field(
+        default_factory=lambda: asyncio.get_running_loop().create_future()
+    )
+
+
+@dataclass
+class UserQueue:
+    weight: float
+    tickets: deque[Ticket] = field(default_factory=deque)
+    virtual_time: float = 0.0
+
+
+class FairScheduler:
+    # Start-time fair queuing: every user is served in proportion to its weight,
+    # no matter how many questions it has queued
+    def __init__(
+        self,
+        backend: str,
+        max_concurrency: int,
+        max_queue: int,
+        max_user_queue: int,
+        max_wait: float,
+        user_weights: dict[uuid.UUID, float],
+    ):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_user_queue = max_user_queue
+        self.max_wait = max_wait
+        self.user_weights = user_weights
+        self.running = 0
+        self.queued = 0
+        self.virtual_time = 0.0
+        self.users: dict[uuid.UUID, UserQueue] = dict()
+
+    def reject(self, status_code: int, detail: str) -> SchedulerRejection:
+        metrics.increment(f"rag.scheduler.{self.backend}.rejected")
+        return SchedulerRejection(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(max(1, round(self.max_wait)))},
+        )
+
+    def enqueue(self, user_id: uuid.UUID, background: bool = False) -> Ticket:
+        if self.queued >= self.max_queue:
+            raise self.reject(
+                status.HTTP_503_SERVICE_UNAVAILABLE,
+                f"{self.backend} RAG service is overloaded, try again later",
+            )
+
+        user_queue = self.users.get(user_id)
+        if user_queue is None:
+            user_queue = UserQueue(
+                weight=self.user_weights.get(user_id, 1.0),
+                virtual_time=self.virtual_time,
+            )
+            self.users[user_id] = user_queue
+        elif not background and len(user_queue.tickets) >= self.max_user_queue:
+            raise self.reject(
+                status.HTTP_429_TOO_MANY_REQUESTS,
+                "Too many questions are waiting for an answer, try again later",
+            )
+
+        ticket = Ticket(user_id=user_id)
+        user_queue.tickets.append(ticket)
+        self.queued += 1
+        self.report()
+        return ticket
+
+    def dispatch(self) -> None:
+        while self.running < self.max_concurrency and self.queued > 0:
+            user_id, user_queue = min(
+                (
+                    (user_id, user_queue)
+                    for user_id, user_queue in self.users.items()
+                    if user_queue.tickets
+                ),
+                key=lambda item: item[1].virtual_time,
+            )
+            ticket = user_queue.tickets.popleft()
+            self.queued -= 1
+            self.virtual_time = user_queue.virtual_time
+            user_queue.virtual_time += 1 / user_queue.weight
+            if not user_queue.tickets:
+                del self.users[user_id]
+            self.running += 1
+            ticket.granted.set_result(None)
+        self.report()
+
+    def position(self, ticket: Ticket) -> int:
+        # Place of a queued ticket in dispatch order: tickets of every user that
+        # start before it in virtual time, its own earlier tickets, then itself.
+        # Ties go to the user that comes first in self.users, like in dispatch
+        user_queue = self.users[ticket.user_id]
+        index = user_queue.tickets.index(ticket)
+        start = user_queue.virtual_time + index / user_queue.weight
+        ahead = index
+        tie_wins = True
+        for user_id, other_queue in self.users.items():
+            if user_id == ticket.user_id:
+                tie_wins = False
+                continue
+            slots = round((start - other_queue.virtual_time) * other_queue.weight, 9)
+            started = math.floor(slots) + 1 if tie_wins else math.ceil(slots)
+            ahead += min(len(other_queue.tickets), max(0, started))
+        return ahead + 1
+
+    def remove(self, ticket: Ticket) -> None:
+        user_queue = self.users.get(ticket.user_id)
+        if user_queue is None or ticket not in user_queue.tickets:
+            return
+        user_queue.tickets.remove(ticket)
+        self.queued -= 1
+        if not user_queue.tickets:
+            del self.users[ticket.user_id]
+        self.report()
+
+    def release(self) -> None:
+        self.running -= 1
+        self.dispatch()
+
+    def report(self) -> None:
+        metrics.set_gauge(f"rag.scheduler.{self.backend}.queued", self.queued)
+        metrics.set_gauge(f"rag.scheduler.{self.backend}.running", self.running)
+
+    @asynccontextmanager
+    async def slot(
+        self, user_id: uuid.UUID, background: bool = False
+    ) -> AsyncIterator[Ticket]:
+        # Background tickets, e.g. batch questions, skip the per-user queue cap and
+        # wait for their turn instead of being rejected after max_wait
+        started_at = time.perf_counter()
+        ticket = self.enqueue(user_id, background=background)
+        self.dispatch()
+        if not ticket.granted.done():
+            ticket.position = self.position(ticket)
+        try:
+            await asyncio.wait_for(
+                asyncio.shield(ticket.granted), None if background else self.max_wait
+            )
+        except BaseException as error:
+            if ticket.granted.done():
+                self.release()
+            else:
+                ticket.granted.cancel()
+                self.remove(ticket)
+            if isinstance(error, asyncio.TimeoutError):
+                raise self.reject(
+                    status.HTTP_503_SERVICE_UNAVAILABLE,
+                    f"{self.backend} RAG service is overloaded, try again later",
+                )
+            raise
+
+        ticket.wait = time.perf_counter() - started_at
+        metrics.observe(f"rag.scheduler.{self.backend}.wait", ticket.wait)
+        try:
+            yield ticket
+        finally:
+            self.release()
+
+
+schedulers = {
+    backend: FairScheduler(
+        backend=backend,
+        max_concurrency=max_concurrency,
+        max_queue=settings.scheduler.scheduler_max_queue,
+        max_user_queue=settings.scheduler.scheduler_max_user_queue,
+        max_wait=settings.scheduler.scheduler_max_wait,
+        user_weights=settings.scheduler.scheduler_user_weights,
+    )
+    for backend, max_concurrency in (
+        ("graph", settings.scheduler.scheduler_graph_concurrency),
+        ("vector", settings.scheduler.scheduler_vector_concurrency),
+    )
+}
@@ -0,0 +1,51 @@
+import asyncio
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from src.shared import ml_models
+from ..config import settings
+
+
+def count_tokens(texts: list[str]) -> list[int]:
+    # Module level so it can be pickled into a process pool worker
+    encodings = ml_models["tokenizer"].encode_batch(texts)
+    return [len(encoding.ids) for encoding in encodings]
+
+
+class TokenizerService:
+    def __init__(self, executor_type: str, max_workers: int):
+        self.executor_type = executor_type
+        self.max_workers = max_workers
+        self.executor: Executor | None = None
+
+    def get_executor(self) -> Executor:
+        if self.executor is None:
+            if self.executor_type == "process":
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="tokenizer"
+                )
+        return self.executor
+
+    async def count_tokens(self, texts: list[str]) -> list[int]:
+        if not texts:
+            return []
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_executor(), count_tokens, texts)
+
+    async def warmup(self) -> None:
+        try:
+            await self.count_tokens([""])
+        except Exception as generic_error:
+            logging.error(f"Tokenizer warmup failed: {generic_error}")
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+tokenizer_service = TokenizerService(
+    executor_type=settings.tokenizer.tokenizer_executor,
+    max_workers=settings.tokenizer.tokenizer_workers,
+)
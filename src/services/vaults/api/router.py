@@ -11,7 +11,12 @@ from ..schemas.vault import (
 )
 from ..schemas.user import UserCredentials
 from ..schemas.document import Document
-from src.dependencies import parse_jwt_bearer, get_aiohttp_session
+from src.dependencies import (
+    parse_jwt_bearer,
+    get_aiohttp_session,
+    limit_uploads,
+    limit_reads,
+)
 from src.schemas import JWTPayload
 from src.services.messaging.service.messaging import MessagingService
 from src.services.messaging.api.dependencies import get_messaging_service
@@ -25,6 +30,7 @@ router = APIRouter(prefix="/vault", tags=["Documents & Vaults"])
 
 @router.post(
     "",
+    dependencies=[Depends(limit_uploads)],
     response_model=VaultPayload,
     status_code=status.HTTP_201_CREATED,
     description="Создание нового хранилища документов. Тип хранилища `vector` или `graph`",
@@ -50,7 +56,7 @@ async def create_vaults(
 
 @router.patch(
     "/document",
-    dependencies=[Depends(parse_jwt_bearer)],
+    dependencies=[Depends(parse_jwt_bearer), Depends(limit_uploads)],
     status_code=status.HTTP_201_CREATED,
     response_model=VaultPayload,
     description="Загрузка нового документа в существующее хранилище",
@@ -132,7 +138,7 @@ async def update_vault_name(
 
 @router.get(
     "/{vault_id}/documents",
-    dependencies=[Depends(parse_jwt_bearer)],
+    dependencies=[Depends(parse_jwt_bearer), Depends(limit_reads)],
     response_model=list[Document],
     description="Получение всех документов, находящихся в хранилище.",
 )
@@ -150,6 +156,7 @@ async def get_vault_documents(
 
 @router.get(
     "/vaults/preview",
+    dependencies=[Depends(limit_reads)],
     response_model=list[VaultPayloadPreview],
     description="Получение превью списка хранилищ, созданных пользователем. **Данные извлекаются из токена!**",
 )
@@ -167,7 +174,7 @@ async def get_users_vaults(
 
 @router.get(
     "/{vault_id}",
-    dependencies=[Depends(parse_jwt_bearer)],
+    dependencies=[Depends(parse_jwt_bearer), Depends(limit_reads)],
     response_model=VaultPayload,
     description="Получение **ВСЕХ** данных о хранилище.",
 )
@@ -185,7 +192,7 @@ async def get_vault(
 
 @router.get(
     "/document/{document_id}",
-    dependencies=[Depends(parse_jwt_bearer)],
+    dependencies=[Depends(parse_jwt_bearer), Depends(limit_reads)],
     response_model=Document,
     description="Получение **ВСЕХ** о определенном документе из хранилища.",
 )
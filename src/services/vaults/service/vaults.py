@@ -10,6 +10,7 @@ from ..schemas.vault import (
     DocumentCredentials,
     UpdateVault,
     VaultPayloadPreview,
+    VaultType,
 )
 from ..schemas.document import Document
 from src.services.messaging.schemas.chat import ChatCredentials
@@ -29,6 +30,8 @@ from ..schemas.user import UserCredentials
 from src.services.messaging.service.messaging import MessagingService
 import aiohttp
 from ..utils.cache import vaults_cache_manager
+from src.services.rag.utils.cache import answer_cache_manager
+from src.single_flight import single_flight
 
 
 class VaultsService:
@@ -52,6 +55,7 @@ class VaultsService:
         await self.cache_manager.set_vault(
             vault_id=vault_payload.id, vault_payload=vault_payload
         )
+        await self.cache_manager.set_vault_types({vault_payload.id: vault_payload.type})
         return vault_payload
 
     async def add_document(
@@ -66,6 +70,7 @@ class VaultsService:
         await self.cache_manager.set_vault(
             vault_id=vault_payload.id, vault_payload=vault_payload
         )
+        await answer_cache_manager.delete_answers(vault_id=vault_payload.id)
         return vault_payload
 
     async def delete_vault_and_chats(
@@ -119,6 +124,8 @@ class VaultsService:
         await self.cache_manager.delete_vault(vault_id=vault_credentials.vault_id)
         await self.cache_manager.delete_vaults_preview(user_id=user_id)
         await self.cache_manager.delete_documents(vault_id=vault_credentials.vault_id)
+        await self.cache_manager.delete_vault_type(vault_id=vault_credentials.vault_id)
+        await answer_cache_manager.delete_answers(vault_id=vault_credentials.vault_id)
         return
 
     async def delete_document(
@@ -134,6 +141,9 @@ class VaultsService:
         await self.cache_manager.delete_documents(
             vault_id=document_credentials.vault_id
         )
+        await answer_cache_manager.delete_answers(
+            vault_id=document_credentials.vault_id
+        )
         return
 
     async def update_vault_name(
@@ -155,48 +165,112 @@ class VaultsService:
         self, vault_credentials: VaultCredentials, session: aiohttp.ClientSession
     ) -> list[Document]:
         documents = await self.cache_manager.get_documents(
-            vault_id=vault_credentials.vault_id
+            vault_id=vault_credentials.vault_id,
+            refresh=lambda: self.fetch_vault_documents(
+                vault_credentials=vault_credentials, session=session
+            ),
         )
         if documents is None:
-            documents = await get_vault_documents_request(
-                session=session,
-                pydantic_model=vault_credentials,
-            )
-            await self.cache_manager.set_documents(
-                vault_id=vault_credentials.vault_id, documents=documents
+            documents = await single_flight.do(
+                key=f"vaults:documents:{vault_credentials.vault_id.hex}",
+                load_cached=lambda: self.cache_manager.get_documents(
+                    vault_id=vault_credentials.vault_id
+                ),
+                fetch=lambda: self.fetch_vault_documents(
+                    vault_credentials=vault_credentials, session=session
+                ),
             )
         return documents
 
+    async def fetch_vault_documents(
+        self, vault_credentials: VaultCredentials, session: aiohttp.ClientSession
+    ) -> list[Document]:
+        documents = await get_vault_documents_request(
+            session=session,
+            pydantic_model=vault_credentials,
+        )
+        await self.cache_manager.set_documents(
+            vault_id=vault_credentials.vault_id, documents=documents
+        )
+        return documents
+
     async def get_user_vaults_preview(
         self, user_credentials: UserCredentials, session: aiohttp.ClientSession
     ) -> list[VaultPayloadPreview]:
         vaults_preview = await self.cache_manager.get_vaults_preview(
-            user_id=user_credentials.user_id
+            user_id=user_credentials.user_id,
+            refresh=lambda: self.fetch_user_vaults_preview(
+                user_credentials=user_credentials, session=session
+            ),
         )
         if vaults_preview is None:
-            vaults_preview = await get_user_vaults_preview_request(
-                session=session,
-                pydantic_model=user_credentials,
-            )
-            await self.cache_manager.set_vaults_preview(
-                user_id=user_credentials.user_id, vaults_preview=vaults_preview
+            vaults_preview = await self.fetch_user_vaults_preview(
+                user_credentials=user_credentials, session=session
             )
         return vaults_preview
 
+    async def fetch_user_vaults_preview(
+        self, user_credentials: UserCredentials, session: aiohttp.ClientSession
+    ) -> list[VaultPayloadPreview]:
+        vaults_preview = await get_user_vaults_preview_request(
+            session=session,
+            pydantic_model=user_credentials,
+        )
+        await self.cache_manager.set_vaults_preview(
+            user_id=user_credentials.user_id, vaults_preview=vaults_preview
+        )
+        await self.cache_manager.set_vault_types(
+            {vault.id: vault.type for vault in vaults_preview}
+        )
+        return vaults_preview
+
     async def get_vault(
         self, vault_credentials: VaultCredentials, session: aiohttp.ClientSession
     ) -> VaultPayload:
-        vault = await self.cache_manager.get_vault(vault_id=vault_credentials.vault_id)
+        vault = await self.cache_manager.get_vault(
+            vault_id=vault_credentials.vault_id,
+            refresh=lambda: self.fetch_vault(
+                vault_credentials=vault_credentials, session=session
+            ),
+        )
         if vault is None:
-            vault = await get_vault_request(
-                session=session,
-                pydantic_model=vault_credentials,
-            )
-            await self.cache_manager.set_vault(
-                vault_id=vault_credentials.vault_id, vault_payload=vault
+            vault = await single_flight.do(
+                key=f"vaults:vault:{vault_credentials.vault_id.hex}",
+                load_cached=lambda: self.cache_manager.get_vault(
+                    vault_id=vault_credentials.vault_id
+                ),
+                fetch=lambda: self.fetch_vault(
+                    vault_credentials=vault_credentials, session=session
+                ),
             )
         return vault
 
+    async def fetch_vault(
+        self, vault_credentials: VaultCredentials, session: aiohttp.ClientSession
+    ) -> VaultPayload:
+        vault = await get_vault_request(
+            session=session,
+            pydantic_model=vault_credentials,
+        )
+        await self.cache_manager.set_vault(
+            vault_id=vault_credentials.vault_id, vault_payload=vault
+        )
+        await self.cache_manager.set_vault_types({vault.id: vault.type})
+        return vault
+
+    async def get_vault_type(
+        self, vault_credentials: VaultCredentials, session: aiohttp.ClientSession
+    ) -> VaultType:
+        vault_type = await self.cache_manager.get_vault_type(
+            vault_id=vault_credentials.vault_id
+        )
+        if vault_type is None:
+            vault = await self.get_vault(
+                vault_credentials=vault_credentials, session=session
+            )
+            vault_type = vault.type
+        return vault_type
+
     async def get_document(
         self, document_credentials: DocumentCredentials, session: aiohttp.ClientSession
     ) -> Document:
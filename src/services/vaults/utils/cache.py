@@ -1,24 +1,53 @@
 import uuid
 import json
+from collections import OrderedDict
+from typing import Awaitable, Callable
 from ..schemas.document import Document
-from ..schemas.vault import VaultPayloadPreview, VaultPayload
+from ..schemas.vault import VaultPayloadPreview, VaultPayload, VaultType
+from src.config import settings, CacheTTL
 from src.repositories.redis import RedisRepository
+from src.local_cache import local_cache
+from src.single_flight import single_flight
 
 
 class VaultsCache:
-    def __init__(self, redis_repository: type(RedisRepository)):
+    def __init__(
+        self,
+        redis_repository: type(RedisRepository),
+        ttls: dict[str, CacheTTL],
+        vault_types_max_size: int,
+    ):
         self.redis: RedisRepository = redis_repository()
+        self.ttls = ttls
+        self.vault_types_max_size = vault_types_max_size
         self.cache_prefix = "vaults:"
         self.documents_prefix = "documents:"
         self.document_prefix = "document:"
         self.vaults_prefix = "vaults:"
         self.vault_prefix = "vault:"
-
-    async def get_documents(self, vault_id: uuid.UUID) -> None | list[Document]:
-        result = await self.redis.get(
-            f"{self.cache_prefix}{self.documents_prefix}{vault_id.hex}"
+        self.types_key = "types"
+        # A vault never changes its type, so entries have no TTL and are only
+        # dropped with the vault or when the map is full
+        self.vault_types: OrderedDict[str, VaultType] = OrderedDict()
+        local_cache.on_drop(self.forget_vault_types)
+
+    async def get_documents(
+        self,
+        vault_id: uuid.UUID,
+        refresh: Callable[[], Awaitable] | None = None,
+    ) -> None | list[Document]:
+        key = f"{self.cache_prefix}{self.documents_prefix}{vault_id.hex}"
+        return await local_cache.get(
+            key,
+            load=lambda: single_flight.get_revalidating(
+                key, cache_ttl=self.ttls["documents"], refresh=refresh
+            ),
+            parse=self.parse_documents,
         )
-        documents_json = json.loads(result) if result else None
+
+    @staticmethod
+    def parse_documents(result: str) -> None | list[Document]:
+        documents_json = json.loads(result)
         documents = (
             [Document.model_validate_json(document) for document in documents_json]
             if documents_json
@@ -31,14 +60,15 @@ class VaultsCache:
     ) -> bool:
         documents_json = [document.model_dump_json() for document in documents]
         documents_str = json.dumps(documents_json)
-        return await self.redis.set(
-            f"{self.cache_prefix}{self.documents_prefix}{vault_id.hex}", documents_str
-        )
+        key = f"{self.cache_prefix}{self.documents_prefix}{vault_id.hex}"
+        local_cache.drop(key)
+        return await self.redis.set(key, documents_str, ttl=self.ttls["documents"].hard)
 
     async def delete_documents(self, vault_id: uuid.UUID) -> bool:
-        return await self.redis.delete(
-            f"{self.cache_prefix}{self.documents_prefix}{vault_id.hex}"
-        )
+        key = f"{self.cache_prefix}{self.documents_prefix}{vault_id.hex}"
+        deleted = await self.redis.delete(key)
+        await local_cache.invalidate(key)
+        return deleted
 
     async def get_document(self, document_id: uuid.UUID) -> None | Document:
         result = await self.redis.get(
@@ -60,12 +90,22 @@ class VaultsCache:
         )
 
     async def get_vaults_preview(
-        self, user_id: uuid.UUID
+        self,
+        user_id: uuid.UUID,
+        refresh: Callable[[], Awaitable] | None = None,
     ) -> None | list[VaultPayloadPreview]:
-        result = await self.redis.get(
-            f"{self.cache_prefix}{self.vaults_prefix}{user_id.hex}"
+        key = f"{self.cache_prefix}{self.vaults_prefix}{user_id.hex}"
+        return await local_cache.get(
+            key,
+            load=lambda: single_flight.get_revalidating(
+                key, cache_ttl=self.ttls["vaults_preview"], refresh=refresh
+            ),
+            parse=self.parse_vaults_preview,
         )
-        vaults_preview_json = json.loads(result) if result else None
+
+    @staticmethod
+    def parse_vaults_preview(result: str) -> None | list[VaultPayloadPreview]:
+        vaults_preview_json = json.loads(result)
         vaults_preview = (
             [
                 VaultPayloadPreview.model_validate_json(vault)
@@ -81,32 +121,102 @@ class VaultsCache:
     ) -> bool:
         vaults_preview_json = [vault.model_dump_json() for vault in vaults_preview]
         vaults_preview_str = json.dumps(vaults_preview_json)
+        key = f"{self.cache_prefix}{self.vaults_prefix}{user_id.hex}"
+        local_cache.drop(key)
         return await self.redis.set(
-            f"{self.cache_prefix}{self.vaults_prefix}{user_id.hex}", vaults_preview_str
+            key, vaults_preview_str, ttl=self.ttls["vaults_preview"].hard
         )
 
     async def delete_vaults_preview(self, user_id: uuid.UUID) -> bool:
-        return await self.redis.delete(
-            f"{self.cache_prefix}{self.vaults_prefix}{user_id.hex}"
-        )
-
-    async def get_vault(self, vault_id: uuid.UUID) -> None | VaultPayload:
-        result = await self.redis.get(
-            f"{self.cache_prefix}{self.vault_prefix}{vault_id.hex}"
+        key = f"{self.cache_prefix}{self.vaults_prefix}{user_id.hex}"
+        deleted = await self.redis.delete(key)
+        await local_cache.invalidate(key)
+        return deleted
+
+    async def get_vault(
+        self,
+        vault_id: uuid.UUID,
+        refresh: Callable[[], Awaitable] | None = None,
+    ) -> None | VaultPayload:
+        key = f"{self.cache_prefix}{self.vault_prefix}{vault_id.hex}"
+        return await local_cache.get(
+            key,
+            load=lambda: single_flight.get_revalidating(
+                key, cache_ttl=self.ttls["vault"], refresh=refresh
+            ),
+            parse=VaultPayload.model_validate_json,
         )
-        vault = VaultPayload.model_validate_json(result) if result else None
-        return vault
 
     async def set_vault(self, vault_id: uuid.UUID, vault_payload: VaultPayload) -> bool:
         vault_str = vault_payload.model_dump_json()
-        return await self.redis.set(
-            f"{self.cache_prefix}{self.vault_prefix}{vault_id.hex}", vault_str
-        )
+        key = f"{self.cache_prefix}{self.vault_prefix}{vault_id.hex}"
+        local_cache.drop(key)
+        return await self.redis.set(key, vault_str, ttl=self.ttls["vault"].hard)
 
     async def delete_vault(self, vault_id: uuid.UUID) -> bool:
-        return await self.redis.delete(
-            f"{self.cache_prefix}{self.vault_prefix}{vault_id.hex}"
+        key = f"{self.cache_prefix}{self.vault_prefix}{vault_id.hex}"
+        deleted = await self.redis.delete(key)
+        await local_cache.invalidate(key)
+        return deleted
+
+    def make_vault_type_key(self, vault_id: uuid.UUID) -> str:
+        # Only names the in-process entry, the types are fields of one Redis hash
+        return f"{self.cache_prefix}{self.types_key}:{vault_id.hex}"
+
+    def remember_vault_type(self, vault_id: uuid.UUID, vault_type: VaultType) -> None:
+        key = self.make_vault_type_key(vault_id)
+        self.vault_types[key] = vault_type
+        self.vault_types.move_to_end(key)
+        while len(self.vault_types) > self.vault_types_max_size:
+            self.vault_types.popitem(last=False)
+
+    def forget_vault_types(self, keys: tuple[str, ...] | None) -> None:
+        if keys is None:
+            self.vault_types.clear()
+            return
+        for key in keys:
+            self.vault_types.pop(key, None)
+
+    async def get_vault_type(self, vault_id: uuid.UUID) -> None | VaultType:
+        key = self.make_vault_type_key(vault_id)
+        vault_type = self.vault_types.get(key)
+        if vault_type is not None:
+            self.vault_types.move_to_end(key)
+            return vault_type
+
+        result = await self.redis.hash_get(
+            f"{self.cache_prefix}{self.types_key}", vault_id.hex
+        )
+        if result is None:
+            return None
+        vault_type = VaultType(result)
+        self.remember_vault_type(vault_id, vault_type)
+        return vault_type
+
+    async def set_vault_types(self, vault_types: dict[uuid.UUID, VaultType]) -> None:
+        for vault_id, vault_type in vault_types.items():
+            self.remember_vault_type(vault_id, vault_type)
+        if vault_types:
+            await self.redis.hash_set(
+                f"{self.cache_prefix}{self.types_key}",
+                {
+                    vault_id.hex: vault_type.value
+                    for vault_id, vault_type in vault_types.items()
+                },
+            )
+        return
+
+    async def delete_vault_type(self, vault_id: uuid.UUID) -> None:
+        await self.redis.hash_delete(
+            f"{self.cache_prefix}{self.types_key}", vault_id.hex
         )
+        # Broadcast through the L1 channel, every worker drops it via its hook
+        await local_cache.invalidate(self.make_vault_type_key(vault_id))
+        return
 
 
-vaults_cache_manager = VaultsCache(RedisRepository)
+vaults_cache_manager = VaultsCache(
+    RedisRepository,
+    ttls=settings.cache_ttls,
+    vault_types_max_size=settings.vault_types_max_size,
+)
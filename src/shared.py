@@ -1,4 +1,46 @@
-from transformers import AutoTokenizer
+import logging
+import threading
+import time
+from pathlib import Path
+from tokenizers import Tokenizer
+from src.config import settings
+from src.metrics import metrics
+
+
+class LazyTokenizer:
+    def __init__(self, path: Path, name: str):
+        self.path = path
+        self.name = name
+        self.tokenizer: Tokenizer | None = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.tokenizer is not None
+
+    def load(self) -> Tokenizer:
+        if self.tokenizer is None:
+            with self.lock:
+                if self.tokenizer is None:
+                    start = time.perf_counter()
+                    if self.path.is_file():
+                        tokenizer = Tokenizer.from_file(str(self.path))
+                    else:
+                        logging.warning(
+                            f"Vendored tokenizer not found at {self.path}, loading {self.name} from the hub"
+                        )
+                        tokenizer = Tokenizer.from_pretrained(self.name)
+                    metrics.set_gauge(
+                        "tokenizer.load_seconds", time.perf_counter() - start
+                    )
+                    self.tokenizer = tokenizer
+        return self.tokenizer
+
+    def encode_batch(self, texts: list[str]) -> list:
+        return self.load().encode_batch(texts)
+
 
 ml_models = dict()
-ml_models["tokenizer"] = AutoTokenizer.from_pretrained("lightblue/suzume-llama-3-8B-multilingual")
+ml_models["tokenizer"] = LazyTokenizer(
+    path=settings.tokenizer.path, name=settings.tokenizer.name
+)
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, TypeVar
+from redis.asyncio.lock import Lock
+from src.config import settings, CacheTTL
+from src.metrics import metrics
+from src.repositories.redis import RedisRepository
+
+Result = TypeVar("Result")
+
+
+class SingleFlight:
+    # Concurrent cache misses of one key share a single upstream fetch: callers
+    # in this process await the same task, other workers wait for the Redis
+    # lease holder to fill the cache. The key is the Redis key the fetch fills,
+    # the lease is renewed for as long as the fetch runs
+    def __init__(
+        self, redis_repository: type(RedisRepository), lease: int, poll_interval: float
+    ):
+        self.redis: RedisRepository = redis_repository()
+        self.cache_prefix = "single_flight:"
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.flights: dict[str, asyncio.Task] = dict()
+        self.refreshes: dict[str, asyncio.Task] = dict()
+
+    async def do(
+        self,
+        key: str,
+        load_cached: Callable[[], Awaitable[Result | None]],
+        fetch: Callable[[], Awaitable[Result]],
+    ) -> Result:
+        flight = self.flights.get(key)
+        if flight is None:
+            # The fetch outlives a cancelled first caller, the others still need it
+            flight = asyncio.create_task(self.fly(key, load_cached, fetch))
+            self.flights[key] = flight
+            flight.add_done_callback(lambda _: self.flights.pop(key, None))
+        else:
+            metrics.increment("single_flight.coalesced")
+        return await asyncio.shield(flight)
+
+    async def fly(
+        self,
+        key: str,
+        load_cached: Callable[[], Awaitable[Result | None]],
+        fetch: Callable[[], Awaitable[Result]],
+    ) -> Result:
+        lease = self.redis.lock(f"{self.cache_prefix}{key}", timeout=self.lease)
+        try:
+            leased = await lease.acquire(blocking=False)
+        except Exception as generic_error:
+            logging.error(f"Single flight lease error: {generic_error}")
+            return await fetch()
+
+        if not leased:
+            result = await self.wait(key, load_cached)
+            if result is not None:
+                metrics.increment("single_flight.remote_hits")
+                return result
+            return await fetch()
+
+        metrics.increment("single_flight.fetches")
+        try:
+            async with self.redis.renewing(lease):
+                return await fetch()
+        finally:
+            await self.release(lease)
+
+    @staticmethod
+    async def release(lease: Lock) -> None:
+        try:
+            await lease.release()
+        except Exception as generic_error:
+            logging.error(f"Single flight lease error: {generic_error}")
+
+    async def get_revalidating(
+        self,
+        key: str,
+        cache_ttl: CacheTTL,
+        refresh: Callable[[], Awaitable] | None = None,
+    ) -> str | None:
+        # Stale values are still returned, the refresh runs behind the response
+        value, ttl_left = await self.redis.get_with_ttl(key)
+        if value is not None and refresh is not None and cache_ttl.is_stale(ttl_left):
+            metrics.increment("single_flight.stale_hits")
+            self.revalidate(key, refresh)
+        return value
+
+    def revalidate(self, key: str, fetch: Callable[[], Awaitable]) -> None:
+        # Refreshes a stale entry in the background, once per key across workers
+        if key in self.refreshes:
+            return
+        refresh = asyncio.create_task(self.refresh(key, fetch))
+        self.refreshes[key] = refresh
+        refresh.add_done_callback(lambda _: self.refreshes.pop(key, None))
+
+    async def refresh(self, key: str, fetch: Callable[[], Awaitable]) -> None:
+        lease = self.redis.lock(f"{self.cache_prefix}{key}", timeout=self.lease)
+        try:
+            if not await lease.acquire(blocking=False):
+                return
+            try:
+                async with self.redis.renewing(lease):
+                    await fetch()
+                metrics.increment("single_flight.revalidations")
+            finally:
+                await self.release(lease)
+        except Exception as generic_error:
+            metrics.increment("single_flight.revalidation_errors")
+            logging.error(f"Background refresh of {key} failed: {generic_error}")
+
+    async def wait(
+        self, key: str, load_cached: Callable[[], Awaitable[Result | None]]
+    ) -> Result | None:
+        # None once the lease is gone without a cached result, e.g. the holder failed.
+        # Redis is polled directly, the cache managers would count every poll
+        try:
+            while True:
+                await asyncio.sleep(self.poll_interval)
+                if await self.redis.exists(key):
+                    return await load_cached()
+                if not await self.redis.exists(f"{self.cache_prefix}{key}"):
+                    return None
+        except Exception as generic_error:
+            logging.error(f"Single flight wait error: {generic_error}")
+        return None
+
+
+single_flight = SingleFlight(
+    RedisRepository,
+    lease=settings.single_flight_lease,
+    poll_interval=settings.single_flight_poll_interval,
+)
@@ -1,20 +1,153 @@
 import jwt
 import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from fastapi import Request, HTTPException, status
 from src.config import settings
+from src.metrics import metrics
 import aiohttp
 import logging
 from functools import wraps
 
 
-async def decode_jwt(
-    token: str,
-    public_key: str = settings.jwt_auth.public_key_path.read_text(),
-    algorithm: str = settings.jwt_auth.algorithm,
-) -> dict:
+class VerifiedTokenCache:
+    # Claims of tokens whose signature was already verified, dropped at "exp"
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.payloads: OrderedDict[bytes, tuple[dict, str | None, float]] = (
+            OrderedDict()
+        )
+
+    @staticmethod
+    def make_digest(token: str) -> bytes:
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    def get(self, token: str) -> tuple[dict, str | None] | None:
+        digest = self.make_digest(token)
+        entry = self.payloads.get(digest)
+        if entry is None:
+            metrics.increment("jwt.claims_cache.misses")
+            return None
+
+        payload, key_id, expires_at = entry
+        if expires_at <= time.time():
+            del self.payloads[digest]
+            metrics.increment("jwt.claims_cache.misses")
+            return None
+        self.payloads.move_to_end(digest)
+        metrics.increment("jwt.claims_cache.hits")
+        return dict(payload), key_id
+
+    def set(self, token: str, payload: dict, key_id: str | None) -> None:
+        expires_at = payload.get("exp")
+        if not isinstance(expires_at, (int, float)):
+            return
+        self.payloads[self.make_digest(token)] = (dict(payload), key_id, expires_at)
+        while len(self.payloads) > self.max_entries:
+            self.payloads.popitem(last=False)
+
+
+class JWTKeySet:
+    # JWKS file re-read once it changes on disk, so keys rotate without a restart.
+    # Keys without "alg" get the algorithm implied by their type and curve
+    default_algorithms = {
+        ("RSA", None): "RS256",
+        ("EC", "P-256"): "ES256",
+        ("OKP", "Ed25519"): "EdDSA",
+        ("OKP", "Ed448"): "EdDSA",
+    }
+
+    def __init__(self, path: Path, algorithms: list[str], reload_interval: float):
+        self.path = path
+        self.algorithms = algorithms
+        self.reload_interval = reload_interval
+        self.keys: dict[str, tuple[Any, str]] = dict()
+        self.modified_at: int | None = None
+        self.checked_at = float("-inf")
+
+    def reload(self) -> None:
+        now = time.monotonic()
+        if now - self.checked_at < self.reload_interval:
+            return
+        self.checked_at = now
+
+        try:
+            modified_at = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            modified_at = None
+        if modified_at == self.modified_at:
+            return
+
+        keys = dict()
+        if modified_at is not None:
+            try:
+                keys = self.parse(json.loads(self.path.read_text()))
+            except Exception as generic_error:
+                # Keep verifying with the previous keys until the file is fixed
+                logging.error(f"JWT key set {self.path} not loaded: {generic_error}")
+                return
+        self.keys = keys
+        self.modified_at = modified_at
+        metrics.set_gauge("jwt.key_set.size", len(keys))
+        logging.info(f"JWT key set loaded with key ids {sorted(keys)}")
+
+    def parse(self, key_set: dict) -> dict[str, tuple[Any, str]]:
+        keys = dict()
+        for jwk in key_set["keys"]:
+            algorithm = jwk.get("alg") or self.default_algorithms.get(
+                (jwk.get("kty"), jwk.get("crv"))
+            )
+            if "kid" not in jwk or algorithm not in self.algorithms:
+                logging.warning(f"JWT key {jwk.get('kid')} skipped")
+                continue
+            keys[jwk["kid"]] = (jwt.PyJWK(jwk, algorithm=algorithm).key, algorithm)
+        return keys
+
+    def get(self, key_id: str) -> tuple[Any, str] | None:
+        self.reload()
+        return self.keys.get(key_id)
+
+
+jwt_public_key = load_pem_public_key(settings.jwt_auth.public_key_path.read_bytes())
+jwt_key_set = JWTKeySet(
+    path=settings.jwt_auth.key_set_path,
+    algorithms=settings.jwt_auth.algorithms,
+    reload_interval=settings.jwt_auth.key_set_reload_interval,
+)
+verified_token_cache = VerifiedTokenCache(
+    max_entries=settings.jwt_auth.claims_cache_size
+)
+
+
+def resolve_jwt_key(token: str) -> tuple[Any, str, str | None]:
+    # Tokens without "kid" predate the key set and are signed with jwt-private.pem
+    key_id = jwt.get_unverified_header(token).get("kid")
+    if key_id is None:
+        return jwt_public_key, settings.jwt_auth.algorithm, None
+    key = jwt_key_set.get(key_id)
+    if key is None:
+        raise jwt.exceptions.InvalidKeyError(f"Unknown JWT key id {key_id}")
+    public_key, algorithm = key
+    return public_key, algorithm, key_id
+
+
+async def decode_jwt(token: str) -> dict:
     try:
+        cached = verified_token_cache.get(token)
+        # A key removed from the key set revokes the tokens it signed
+        if cached is not None and (
+            cached[1] is None or jwt_key_set.get(cached[1]) is not None
+        ):
+            return cached[0]
+
+        public_key, algorithm, key_id = resolve_jwt_key(token)
         payload = await asyncio.to_thread(
-            jwt.decode, jwt=token, key=public_key, algorithms=algorithm
+            jwt.decode, jwt=token, key=public_key, algorithms=[algorithm]
         )
     except jwt.exceptions.ExpiredSignatureError as expired_token:
         raise HTTPException(
@@ -29,6 +162,8 @@ async def decode_jwt(
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token"
         )
+
+    verified_token_cache.set(token, payload, key_id=key_id)
     return payload
 
 
@@ -36,6 +171,33 @@ async def get_aiohttp_session(request: Request) -> aiohttp.ClientSession:
     return request.state.client_session
 
 
+def aiohttp_error_to_http_exception(
+    service_name: str, error: Exception
+) -> HTTPException:
+    logging.error(error)
+    if isinstance(error, HTTPException):
+        return error
+    if isinstance(error, aiohttp.ClientConnectionError):
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"{service_name} service is temporarily unavailable.",
+        )
+    if isinstance(error, asyncio.TimeoutError):
+        return HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail=f"{service_name} service timed out.",
+        )
+    if isinstance(error, aiohttp.ContentTypeError):
+        return HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail=f"{service_name} service returned invalid content type.",
+        )
+    return HTTPException(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        detail=f"{service_name} service encountered an unexpected error occurred.",
+    )
+
+
 def aiohttp_error_handler(service_name: str):
     """
     Custom decorator to handle aiohttp errors
@@ -48,32 +210,28 @@ def aiohttp_error_handler(service_name: str):
             try:
                 # Call the decorated function
                 return await func(*args, **kwargs)
-            except aiohttp.ClientConnectionError as connect_error:
-                logging.error(connect_error)
-                raise HTTPException(
-                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                    detail=f"{service_name} service is temporarily unavailable.",
-                )
-            except asyncio.TimeoutError as timeout_error:
-                logging.error(timeout_error)
-                raise HTTPException(
-                    status_code=status.HTTP_504_GATEWAY_TIMEOUT,
-                    detail=f"{service_name} service timed out.",
-                )
-            except aiohttp.ContentTypeError as content_error:
-                logging.error(content_error)
-                raise HTTPException(
-                    status_code=status.HTTP_502_BAD_GATEWAY,
-                    detail=f"{service_name} service returned invalid content type.",
-                )
             except Exception as generic_error:
-                logging.error(generic_error)
-                if isinstance(generic_error, HTTPException):
-                    raise generic_error
-                raise HTTPException(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    detail=f"{service_name} service encountered an unexpected error occurred.",
-                )
+                raise aiohttp_error_to_http_exception(service_name, generic_error)
+
+        return wrapper
+
+    return decorator
+
+
+def aiohttp_stream_error_handler(service_name: str):
+    """
+    Custom decorator to handle aiohttp errors of async generators
+    """
+    service_name = service_name.capitalize()
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                async for item in func(*args, **kwargs):
+                    yield item
+            except Exception as generic_error:
+                raise aiohttp_error_to_http_exception(service_name, generic_error)
 
         return wrapper
 